@@ -11,6 +11,7 @@ export default tseslint.config(
       "docs/tools/",
       "theme/",
       "**/webpack.config.js",
+      "**/bundle-loader.cjs",
       "**/build",
       // TODO: lint fixtures and test, but make sure they don't end up in the
       // bundle
@@ -0,0 +1,95 @@
+# Batch grading of stored submissions with the Node helpers.
+#
+# This is for regrading many submissions outside the browser, so it's not
+# part of the helpers that are loaded into Pyodide. The checks use the same
+# format as Node.check_all and have to be picklable, i.e. tuples of a method
+# name and arguments or module-level functions. A plan from compile_plan can be
+# used instead of a list of checks:
+#
+#   grader = BatchGrader([("has_function", "foo"), ("has_import", "import math")])
+#   for verdict in grader.grade(submissions):
+#       print(verdict["index"], verdict["results"], verdict["error"])
+#   grader.stats()  # {"submissions": ..., "seconds": ..., "per_second": ...}
+
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from py_helpers import Node
+
+
+def _grade_one(source, checks):
+    try:
+        if hasattr(checks, "run"):
+            return {"results": checks.run(Node(source)), "error": None}
+        return {"results": Node(source).check_all(checks), "error": None}
+    except Exception as err:
+        return {"results": None, "error": f"{type(err).__name__}: {err}"}
+
+
+def _grade_chunk(start, sources, checks):
+    return [
+        {"index": start + i, **_grade_one(source, checks)}
+        for i, source in enumerate(sources)
+    ]
+
+
+def _chunks(submissions, chunksize):
+    iterator = iter(submissions)
+    start = 0
+    while chunk := list(islice(iterator, chunksize)):
+        yield start, chunk
+        start += len(chunk)
+
+
+class BatchGrader:
+    # processes=None uses one process per CPU and processes=0 grades in the
+    # current process. At most max_pending chunks are queued at a time, so the
+    # submissions can be a generator over a much larger store.
+    def __init__(self, checks, processes=None, chunksize=100, max_pending=None):
+        self.checks = checks if hasattr(checks, "run") else list(checks)
+        self.processes = processes
+        self.chunksize = chunksize
+        self.max_pending = max_pending
+        self._submissions = 0
+        self._seconds = 0.0
+
+    def grade(self, submissions):
+        self._submissions = 0
+        start = time.perf_counter()
+        try:
+            for verdicts in self._grade_chunks(_chunks(submissions, self.chunksize)):
+                self._submissions += len(verdicts)
+                self._seconds = time.perf_counter() - start
+                yield from verdicts
+        finally:
+            self._seconds = time.perf_counter() - start
+
+    def _grade_chunks(self, chunks):
+        if self.processes == 0:
+            for start, sources in chunks:
+                yield _grade_chunk(start, sources, self.checks)
+            return
+
+        with ProcessPoolExecutor(max_workers=self.processes) as executor:
+            max_pending = self.max_pending or 2 * (
+                self.processes or os.cpu_count() or 1
+            )
+            pending = deque()
+            for start, sources in chunks:
+                pending.append(
+                    executor.submit(_grade_chunk, start, sources, self.checks)
+                )
+                if len(pending) >= max_pending:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def stats(self):
+        return {
+            "submissions": self._submissions,
+            "seconds": self._seconds,
+            "per_second": (self._submissions / self._seconds if self._seconds else 0.0),
+        }
@@ -0,0 +1,541 @@
+# Micro-benchmarks for the Node helpers and format_exception.
+#
+# Every public Node method is run against a fixed corpus of learner-style
+# programs, from a short exercise to a very large file, and the per-call
+# latency, memory allocated and peak memory are written out as JSON:
+#
+#   python benchmark.py --output before.json
+#   python benchmark.py --output after.json --compare before.json
+#
+# With --imports, the time a new process takes to import the helpers, from the
+# source and from the bundle built by bundle.py, is measured instead. Use
+# --import-budget-ms to fail if either takes longer than the budget:
+#
+#   python benchmark.py --imports --import-budget-ms 50
+#
+# Only the standard library is used, so this runs wherever the helpers do.
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import bundle
+from py_helpers import Node, clear_caches
+from format_exception import clear_exception_cache, extract_exception, format_exception
+
+# A program in the style of the Python curriculum projects, which uses every
+# construct the helpers know about.
+
+PROGRAM = """
+import math
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+
+
+class Category(ABC):
+    def __init__(self, name):
+        self.name = name
+        self.ledger = []
+
+    @property
+    @abstractmethod
+    def balance(self):
+        return sum(item["amount"] for item in self.ledger)
+
+    def deposit(self, amount, description=""):
+        self.ledger.append({"amount": amount, "description": description})
+
+    def withdraw(self, amount: float, description: str = "") -> bool:
+        if self.check_funds(amount):
+            self.ledger.append({"amount": -amount, "description": description})
+            return True
+        return False
+
+    def check_funds(self, amount):
+        return amount <= self.balance
+
+
+def create_spend_chart(categories):
+    total = 0
+    spent = [c.balance for c in categories if c.balance > 0]
+    lookup = {c.name: c.balance for c in categories}
+    for category in categories:
+        total += category.balance
+    percentages = [math.floor(s / total * 10) * 10 for s in spent]
+    i = 100
+    while i >= 0:
+        print(str(i).rjust(3) + "|")
+        i -= 10
+    if total > 100:
+        print("big")
+    elif total > 10:
+        print("medium")
+    else:
+        print("small")
+    return percentages
+
+
+async def fetch_rates(client):
+    await client.connect()
+    await client.close()
+
+
+def parse(command):
+    match command.split():
+        case [action]:
+            return action
+        case [action, obj] if obj:
+            return obj
+        case _:
+            pass
+
+
+def safe_divide(a, b):
+    try:
+        result = a / b
+    except ZeroDivisionError as e:
+        print(e)
+    except TypeError:
+        pass
+    else:
+        return result
+    finally:
+        print("done")
+
+
+x = 1
+count = 0
+count += 1
+food = Category("Food")
+food.deposit(1000, "initial deposit")
+[n * 2 for n in range(10)]
+print(create_spend_chart([food]))
+"""
+
+# Filler that makes the larger programs more realistic than just repeating
+# PROGRAM. Each copy gets different names so that lookups have to skip it.
+
+FILLER = """
+def helper_{n}(values, limit={n}):
+    total_{n} = 0
+    for value in values:
+        if value > limit:
+            total_{n} += value
+        else:
+            total_{n} -= 1
+    return total_{n}
+
+
+class Model{n}:
+    def __init__(self):
+        self.value = {n}
+
+    def describe(self):
+        return f"Model {{self.value}}"
+
+
+result_{n} = helper_{n}([1, 2, 3])
+print(result_{n})
+"""
+
+
+def _program(fillers):
+    return "".join(FILLER.format(n=n) for n in range(fillers)) + PROGRAM
+
+
+CORPUS = {
+    "small": PROGRAM,
+    "medium": _program(10),
+    "large": _program(100),
+    "very_large": _program(1000),
+}
+
+# Each case is a function that receives a Node of the corpus program and
+# returns a zero-argument function that calls the method being measured. The
+# Nodes needed to make the call are found before timing starts.
+
+
+def _method(name, *args, on=lambda node: node):
+    def setup(node):
+        target = on(node)
+        method = getattr(target, name)
+        return lambda: method(*args)
+
+    return setup
+
+
+def _consume(name, *args, on=lambda node: node):
+    def setup(node):
+        target = on(node)
+        method = getattr(target, name)
+        return lambda: list(method(*args))
+
+    return setup
+
+
+def _class(node):
+    return node.find_class("Category")
+
+
+def _chart(node):
+    return node.find_function("create_spend_chart")
+
+
+def _withdraw(node):
+    return _class(node).find_function("withdraw")
+
+
+def _balance(node):
+    return _class(node).find_function("balance")
+
+
+def _spent(node):
+    return _chart(node).find_variable("spent")
+
+
+def _lookup(node):
+    return _chart(node).find_variable("lookup")
+
+
+def _for(node):
+    return _chart(node).find_for_loops()[0]
+
+
+def _if(node):
+    return _chart(node).find_ifs()[0]
+
+
+def _try(node):
+    return node.find_function("safe_divide").find_trys()[0]
+
+
+def _match(node):
+    return node.find_function("parse").find_matches()[0]
+
+
+def _case(node):
+    return _match(node).find_match_cases()[1]
+
+
+CASES = {
+    "Node": lambda node: lambda: Node(str(node)),
+    "__eq__": lambda node: lambda: node == Node(node.tree),
+    "__hash__": lambda node: lambda: hash(node),
+    "__getitem__": lambda node: lambda: node[-1],
+    "__len__": lambda node: lambda: len(node),
+    "__repr__": lambda node: lambda: repr(node),
+    "__str__": lambda node: lambda: str(node),
+    "block_has_call": _method("block_has_call", "print", "create_spend_chart"),
+    "check_all": _method(
+        "check_all",
+        [
+            ("has_function", "create_spend_chart"),
+            ("has_class", "Category"),
+            ("has_import", "import math"),
+            ("has_call", "print(create_spend_chart([food]))"),
+            ("find_ifs",),
+        ],
+    ),
+    "find_async_function": _method("find_async_function", "fetch_rates"),
+    "find_aug_variable": _method("find_aug_variable", "count"),
+    "find_awaits": _method(
+        "find_awaits", on=lambda n: n.find_async_function("fetch_rates")
+    ),
+    "find_bodies": _method("find_bodies", on=_if),
+    "find_body": _method("find_body", on=_chart),
+    "find_call_args": _method("find_call_args", on=lambda n: n.find_calls("print")[-1]),
+    "find_calls": _method("find_calls", "print"),
+    "find_case_guard": _method("find_case_guard", on=_case),
+    "find_case_pattern": _method("find_case_pattern", on=_case),
+    "find_class": _method("find_class", "Category"),
+    "find_comp_expr": _method("find_comp_expr", on=_lookup),
+    "find_comp_ifs": _method("find_comp_ifs", on=_spent),
+    "find_comp_iters": _method("find_comp_iters", on=_spent),
+    "find_comp_key": _method("find_comp_key", on=_lookup),
+    "find_comp_targets": _method("find_comp_targets", on=_spent),
+    "find_comps": _method("find_comps"),
+    "find_conditions": _method("find_conditions", on=_if),
+    "find_except": _method("find_except", "ZeroDivisionError", "e", on=_try),
+    "find_excepts": _method("find_excepts", on=_try),
+    "find_finally": _method("find_finally", on=_try),
+    "find_for": _method("find_for", "category", "categories", on=_chart),
+    "find_for_iter": _method("find_for_iter", on=_for),
+    "find_for_loops": _method("find_for_loops", on=_chart),
+    "find_for_vars": _method("find_for_vars", on=_for),
+    "find_function": _method("find_function", "create_spend_chart"),
+    "find_functions": _method("find_functions", "balance", on=_class),
+    "find_if": _method("find_if", "total > 100", on=_chart),
+    "find_ifs": _method("find_ifs", on=_chart),
+    "find_imports": _method("find_imports"),
+    "find_match_cases": _method("find_match_cases", on=_match),
+    "find_match_subject": _method("find_match_subject", on=_match),
+    "find_matches": _method("find_matches", on=lambda n: n.find_function("parse")),
+    "find_return": _method("find_return", on=_chart),
+    "find_try_else": _method("find_try_else", on=_try),
+    "find_trys": _method("find_trys", on=lambda n: n.find_function("safe_divide")),
+    "find_variable": _method("find_variable", "food"),
+    "find_variables": _method("find_variables", "x"),
+    "find_while": _method("find_while", "i >= 0", on=_chart),
+    "find_whiles": _method("find_whiles", on=_chart),
+    "get_variable": _method("get_variable", "x"),
+    "has_args": _method(
+        "has_args", "self, amount: float, description: str = ''", on=_withdraw
+    ),
+    "has_call": _method("has_call", "print(create_spend_chart([food]))"),
+    "has_class": _method("has_class", "Category"),
+    "has_decorators": _method("has_decorators", "property", on=_balance),
+    "has_except": _method("has_except", "TypeError", on=_try),
+    "has_function": _method("has_function", "create_spend_chart"),
+    "has_import": _method("has_import", "import math"),
+    "has_pass": _method("has_pass", on=_case),
+    "has_pattern": _method("has_pattern", "print(__any__)"),
+    "has_return": _method("has_return", "percentages", on=_chart),
+    "has_returns": _method("has_returns", "bool", on=_withdraw),
+    "has_stmt": _method("has_stmt", "print(create_spend_chart([food]))"),
+    "has_variable": _method("has_variable", "food"),
+    "inherits_from": _method("inherits_from", "ABC", on=_class),
+    "is_empty": _method("is_empty"),
+    "is_equivalent": _method("is_equivalent", "i -= 10", on=lambda n: n[-1]),
+    "is_integer": _method("is_integer", on=lambda n: n.find_variable("x")),
+    "is_ordered": _method("is_ordered", "x = 1", "count = 0", "count += 1"),
+    "is_structurally_equal": _method(
+        "is_structurally_equal", "print(create_spend_chart([food]))", on=lambda n: n[-1]
+    ),
+    "iter_awaits": _consume(
+        "iter_awaits", on=lambda n: n.find_async_function("fetch_rates")
+    ),
+    "iter_calls": _consume("iter_calls", "print", True),
+    "iter_comps": _consume("iter_comps", True),
+    "iter_for_loops": _consume("iter_for_loops", True),
+    "iter_functions": _consume("iter_functions", "describe", True),
+    "iter_ifs": _consume("iter_ifs", True),
+    "iter_imports": _consume("iter_imports"),
+    "iter_matches": _consume("iter_matches", True),
+    "iter_trys": _consume("iter_trys", True),
+    "iter_variables": _consume("iter_variables", "self.value", True),
+    "iter_whiles": _consume("iter_whiles", True),
+    "match_pattern": _method("match_pattern", "for __x__ in __it__: ...", on=_for),
+    "reparse": lambda node: lambda: node.reparse(
+        str(node.tree._source_text).replace("x = 1", "x = 2")
+    ),
+    "value_is_call": _method(
+        "value_is_call", "Category", on=lambda n: n.find_variable("food")
+    ),
+}
+
+
+def _exception_case(depth, function=format_exception, **options):
+    code = compile(
+        "def nest(n):\n    if n == 0:\n        raise ValueError('oops')\n"
+        "    nest(n - 1)\n\nnest(DEPTH)\n",
+        "<benchmark>",
+        "exec",
+    )
+
+    def setup(_node):
+        try:
+            exec(code, {"DEPTH": depth})
+        except ValueError as exception:
+            error = exception
+        return lambda: function(
+            exception=error,
+            traceback=error.__traceback__,
+            filename="<benchmark>",
+            **options,
+        )
+
+    return setup
+
+
+EXCEPTION_CASES = {
+    "format_exception": _exception_case(5),
+    "format_exception_deep": _exception_case(500),
+    "extract_exception": _exception_case(5, extract_exception),
+    "format_exception_deep_limited": _exception_case(
+        500, head=10, tail=10, max_size=4096
+    ),
+}
+
+
+def _measure(setup, source, number):
+    clear_caches()
+    clear_exception_cache()
+    node = Node(source)
+    call = setup(node)
+
+    # The first call after the caches are cleared pays for any indexing.
+    start = time.perf_counter()
+    call()
+    cold = time.perf_counter() - start
+
+    timings = []
+    for _ in range(number):
+        start = time.perf_counter()
+        call()
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        result = call()
+        after, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+
+    return {
+        "cold_us": cold * 1e6,
+        "min_us": timings[0] * 1e6,
+        "median_us": timings[len(timings) // 2] * 1e6,
+        "mean_us": sum(timings) / len(timings) * 1e6,
+        "allocated_bytes": after - before,
+        "peak_bytes": peak - before,
+    }
+
+
+def run(corpus=None, cases=None, number=20):
+    cases = cases or [*CASES, *EXCEPTION_CASES]
+    all_cases = {**CASES, **EXCEPTION_CASES}
+    results = []
+    for corpus_name in corpus or CORPUS:
+        source = CORPUS[corpus_name]
+        for case in cases:
+            # format_exception doesn't depend on the corpus.
+            if case in EXCEPTION_CASES and corpus_name != "small":
+                continue
+            measurement = _measure(all_cases[case], source, number)
+            results.append({"case": case, "corpus": corpus_name, **measurement})
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "number": number,
+        "results": results,
+    }
+
+
+# Each import runs in a new process, which is how the worker imports the
+# helpers. -B stops the source import from writing its own bytecode.
+
+_IMPORT = """
+import sys, time
+sys.path.insert(0, sys.argv[1])
+start = time.perf_counter()
+import ast_helpers
+print(time.perf_counter() - start)
+"""
+
+
+def _time_import(directory):
+    output = subprocess.run(
+        [sys.executable, "-B", "-c", _IMPORT, directory],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return float(output.splitlines()[-1])
+
+
+def measure_imports(number=20):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in ("source", "bundle"):
+            directory = os.path.join(tmp, mode)
+            os.makedirs(directory)
+            filename = os.path.join(directory, "ast_helpers.py")
+            shutil.copyfile(bundle.SOURCE, filename)
+            if mode == "bundle":
+                bundle.build(os.path.join(directory, "__pycache__"), filename=filename)
+            timings = sorted(_time_import(directory) for _ in range(number))
+            results[mode] = {
+                "min_ms": timings[0] * 1e3,
+                "median_ms": timings[len(timings) // 2] * 1e3,
+            }
+    return results
+
+
+def compare(report, baseline):
+    if "imports" in report:
+        return [
+            {
+                "import": mode,
+                "median_ratio": result["median_ms"] / previous["median_ms"],
+            }
+            for mode, result in report["imports"].items()
+            if (previous := baseline.get("imports", {}).get(mode))
+        ]
+    old = {(r["case"], r["corpus"]): r for r in baseline.get("results", [])}
+    rows = []
+    for result in report.get("results", []):
+        previous = old.get((result["case"], result["corpus"]))
+        if previous is None or not previous["median_us"]:
+            continue
+        rows.append(
+            {
+                "case": result["case"],
+                "corpus": result["corpus"],
+                "median_ratio": result["median_us"] / previous["median_us"],
+                "peak_bytes_delta": result["peak_bytes"] - previous["peak_bytes"],
+            }
+        )
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Python helpers.")
+    parser.add_argument("--output", help="write the JSON report to this file")
+    parser.add_argument("--compare", help="a previous JSON report to compare with")
+    parser.add_argument("--corpus", action="append", choices=list(CORPUS))
+    parser.add_argument("--case", action="append", help="only run these cases")
+    parser.add_argument("--number", type=int, default=20, help="calls per case")
+    parser.add_argument(
+        "--imports", action="store_true", help="measure importing the helpers"
+    )
+    parser.add_argument(
+        "--import-budget-ms", type=float, help="fail if importing takes longer"
+    )
+    args = parser.parse_args(argv)
+
+    if args.imports or args.import_budget_ms is not None:
+        report = {
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "number": args.number,
+            "imports": measure_imports(args.number),
+        }
+    else:
+        report = run(corpus=args.corpus, cases=args.case, number=args.number)
+    if args.compare:
+        with open(args.compare) as f:
+            report["comparison"] = compare(report, json.load(f))
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        sys.stdout.write(output + "\n")
+
+    if args.import_budget_ms is not None:
+        over = {
+            mode: result["median_ms"]
+            for mode, result in report["imports"].items()
+            if result["median_ms"] > args.import_budget_ms
+        }
+        if over:
+            sys.exit(
+                f"Importing the helpers took longer than {args.import_budget_ms} ms: "
+                + ", ".join(f"{mode} {ms:.1f} ms" for mode, ms in over.items())
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,30 @@
+// Builds the bytecode bundle of the Python helpers with bundle.py, for imports
+// like "py_helpers.py?bundle". The module exports the name the bundle has to
+// be written under in __pycache__ and its contents, base64 encoded. Set PYTHON
+// to choose the interpreter, which has to be the version Pyodide ships.
+const { execFileSync } = require("child_process");
+const fs = require("fs");
+const os = require("os");
+const path = require("path");
+
+module.exports = function bundleLoader() {
+  const output = fs.mkdtempSync(path.join(os.tmpdir(), "ast-helpers-"));
+  try {
+    const bundle = execFileSync(
+      process.env.PYTHON || "python3",
+      [
+        path.join(__dirname, "bundle.py"),
+        "--output",
+        output,
+        "--source",
+        this.resourcePath,
+      ],
+      { encoding: "utf8" },
+    ).trim();
+    const name = path.basename(bundle);
+    const data = fs.readFileSync(bundle).toString("base64");
+    return `export default ${JSON.stringify({ name, data })};`;
+  } finally {
+    fs.rmSync(output, { recursive: true, force: true });
+  }
+};
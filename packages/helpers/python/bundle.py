@@ -0,0 +1,68 @@
+# Builds the Node helpers as precompiled bytecode, so that a new worker can
+# import them without compiling the source first. Compiling is most of the cost
+# of importing the helpers.
+#
+# The bytecode only works with the Python version that built it, so this has
+# to be run with the Python version that Pyodide ships (PYODIDE_CACHE_TAG):
+#
+#   python bundle.py --output dist/
+#
+# This writes dist/ast_helpers.<cache tag>.pyc (e.g. ast_helpers.cpython-311.pyc),
+# which goes in /home/pyodide/__pycache__/ next to ast_helpers.py. The build
+# runs this through bundle-loader.cjs, and the Python evaluator writes the
+# bundle to the worker's filesystem. The bundle
+# stores a hash of the source it was built from, which is checked when it's
+# imported. If ast_helpers.py has changed since, or the worker's Python doesn't
+# match, the bundle is ignored and the source is compiled as before. Checking
+# the hash means reading and hashing the source, which is much cheaper than
+# compiling it.
+
+import argparse
+import os
+import py_compile
+import sys
+
+SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "py_helpers.py")
+FILENAME = "/home/pyodide/ast_helpers.py"
+
+# Pyodide 0.23 ships CPython 3.11. Update this with the Pyodide version.
+PYODIDE_CACHE_TAG = "cpython-311"
+
+
+def bundle_name(module="ast_helpers"):
+    return f"{module}.{sys.implementation.cache_tag}.pyc"
+
+
+def build(output, source=SOURCE, filename=FILENAME):
+    os.makedirs(output, exist_ok=True)
+    module = os.path.splitext(os.path.basename(filename))[0]
+    path = os.path.join(output, bundle_name(module))
+    py_compile.compile(
+        source,
+        cfile=path,
+        dfile=filename,
+        doraise=True,
+        invalidation_mode=py_compile.PycInvalidationMode.CHECKED_HASH,
+    )
+    return path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Precompile the Python helpers.")
+    parser.add_argument("--output", default=".", help="directory to write to")
+    parser.add_argument("--source", default=SOURCE, help="the helpers to compile")
+    parser.add_argument(
+        "--filename", default=FILENAME, help="where the worker imports them from"
+    )
+    args = parser.parse_args(argv)
+
+    if sys.implementation.cache_tag != PYODIDE_CACHE_TAG:
+        parser.error(
+            f"the bundle has to be built with {PYODIDE_CACHE_TAG}, "
+            f"not {sys.implementation.cache_tag}"
+        )
+    sys.stdout.write(build(args.output, args.source, args.filename) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -19,20 +19,511 @@ def _replace_startswith(string, old, new):
     return string
 
 
-def format_exception(*, exception, traceback, filename, new_filename=None):
+# The learner's source can be registered in memory once per submission, so
+# that the lines shown in the traceback are never read from the filesystem.
+# Register it under the filename the code is run with (i.e. the filename passed
+# to format_exception, not new_filename). Registering a source replaces the one
+# registered before it under the same name and clear_sources removes them all.
+#
+# register_source(filename="/user_code.py", source=code)
+
+_registered = set()
+
+
+def register_source(*, filename, source):
+    import linecache
+    from io import StringIO
+
+    # Splits the lines like linecache does for files. str.splitlines also
+    # splits on characters like form feeds, which don't end lines.
+    lines = StringIO(source, newline=None).readlines()
+    if lines and not lines[-1].endswith("\n"):
+        lines[-1] += "\n"
+    # Entries without a modification time are never checked against the
+    # filesystem by linecache.checkcache.
+    linecache.cache[filename] = (len(source), None, lines, filename)
+    _registered.add(filename)
+
+
+def clear_sources():
+    import linecache
+
+    for filename in _registered:
+        linecache.cache.pop(filename, None)
+    _registered.clear()
+
+
+# Set by py_helpers while a profile is active, see py_helpers.profile. A profile
+# can already be active when this module is imported (e.g. one started with
+# PY_HELPERS_PROFILE), so the hook is looked up here too. The helpers are
+# imported as ast_helpers in the worker.
+
+
+def _active_profile_hook():
+    import sys
+
+    for name in ("py_helpers", "ast_helpers"):
+        helpers = sys.modules.get(name)
+        if helpers is not None and helpers.current_profile() is not None:
+            return helpers._format_exception_hook
+    return None
+
+
+_profile_hook = _active_profile_hook()
+
+
+# With head and/or tail, only that many frames from the start and the end of
+# the user's traceback are shown. max_size limits the length of the output,
+# which is only exceeded if the lines describing the exception itself are
+# longer. The frames that are left out are replaced by a
+# "[N more frames not shown]" line, and they are never formatted.
+
+
+def format_exception(
+    *,
+    exception,
+    traceback,
+    filename,
+    new_filename=None,
+    head=None,
+    tail=None,
+    max_size=None,
+):
+    kwargs = dict(
+        exception=exception,
+        traceback=traceback,
+        filename=filename,
+        new_filename=new_filename,
+        head=head,
+        tail=tail,
+        max_size=max_size,
+    )
+    if _profile_hook is not None:
+        return _profile_hook(_format_exception, kwargs)
+    return _format_exception(**kwargs)
+
+
+# The frames up to the first one in "filename" are not part of the user's code,
+# so they're skipped before anything is formatted.
+
+
+def _user_traceback(traceback, filename):
+    while traceback is not None and traceback.tb_frame.f_code.co_filename != filename:
+        traceback = traceback.tb_next
+    return traceback
+
+
+# Like the traceback module, only the first _REPEATED frames of a run of
+# identical frames (as in runaway recursion) are shown, and the rest are
+# counted. Returns [position, traceback, repeated] for each frame that's kept
+# and the total number of frames.
+
+_REPEATED = 3
+
+
+def _collapse(traceback):
+    kept = []
+    position = 0
+    last = None
+    run = 0
+    while traceback is not None:
+        code = traceback.tb_frame.f_code
+        key = (code.co_filename, traceback.tb_lineno, code.co_name)
+        run = run + 1 if key == last else 1
+        last = key
+        if run > _REPEATED:
+            kept[-1][2] += 1
+        else:
+            kept.append([position, traceback, 0])
+        position += 1
+        traceback = traceback.tb_next
+    return kept, position
+
+
+def _limit(kept, head, tail):
+    if head is None and tail is None:
+        return kept, 0, 0
+    head = head or 0
+    tail = tail or 0
+    if head + tail >= len(kept):
+        return kept, 0, 0
+    left_out = kept[head : len(kept) - tail]
+    omitted = sum(1 + repeated for _, _, repeated in left_out)
+    return kept[:head] + kept[len(kept) - tail :], omitted, head
+
+
+# The frames are extracted a few consecutive frames at a time, so that none
+# are extracted (and their lines looked up) if formatting stops early.
+
+_CHUNK = 16
+
+
+def _extract_frames(kept, filename, new_filename):
+    from traceback import extract_tb
+
+    i = 0
+    while i < len(kept):
+        j = i + 1
+        while j < len(kept) and j - i < _CHUNK and kept[j][0] == kept[j - 1][0] + 1:
+            j += 1
+        for (_, _, repeated), frame in zip(
+            kept[i:j], extract_tb(kept[i][1], limit=j - i)
+        ):
+            yield _frame(frame, filename, new_filename, repeated)
+        i = j
+
+
+# The lines from lineno to end_lineno as they are in the source, or none if the
+# source can't be found.
+
+
+def _source_lines(filename, lineno, end_lineno):
+    from linecache import getline
+
+    if not lineno or not getline(filename, lineno):
+        return []
+    if end_lineno is None or end_lineno < lineno:
+        end_lineno = lineno
+    return [getline(filename, n) for n in range(lineno, end_lineno + 1)]
+
+
+def _frame(frame, filename, new_filename, repeated):
+    end_lineno = getattr(frame, "end_lineno", None)
+    lines = (
+        _source_lines(frame.filename, frame.lineno, end_lineno) if frame.line else []
+    )
+    return {
+        "filename": new_filename if frame.filename == filename else frame.filename,
+        "lineno": frame.lineno,
+        "function": frame.name,
+        "line": frame.line or "",
+        "lines": lines,
+        "end_lineno": end_lineno,
+        "colno": getattr(frame, "colno", None),
+        "end_colno": getattr(frame, "end_colno", None),
+        "repeated": repeated,
+    }
+
+
+def _type_name(exception):
+    exception_type = type(exception)
+    if exception_type.__module__ in ("__main__", "builtins"):
+        return exception_type.__qualname__
+    return f"{exception_type.__module__}.{exception_type.__qualname__}"
+
+
+# The structured form of a formatted exception, for storing and analysing
+# exceptions in bulk:
+#
+# {
+#     "type": "ValueError",
+#     "message": "This error has no value",
+#     "frames": [
+#         {"filename": "main.py", "lineno": 3, "function": "nest", "line": ...},
+#     ],
+#     "exception": ["ValueError: This error has no value\n"],
+#     "frame_count": 1,
+#     "omitted": 0,
+#     "omitted_at": 0,
+# }
+#
+# "line" is the frame's line, stripped. The frames also have the "lines" of the
+# code that raised the exception as they are in the source, its position (or
+# None) with the columns in bytes as Python reports them, and how many times
+# they were repeated after being shown. "exception" has the lines that end the
+# traceback. "frame_count" counts all the user's frames, including the ones
+# left out by head and tail: "omitted" of them, after the first "omitted_at"
+# frames. format_extracted builds the same message as
+# format_exception.
+
+
+def _extract(*, exception, traceback, filename, new_filename, head, tail):
     if new_filename is None:
         new_filename = filename
-    from traceback import format_exception_only, format_tb
-
-    # The trace up to "filename" are the frames that are not part of the user's
-    # code so we drop them.
-    traces = drop_until(traces=format_tb(traceback), filename=filename)
-    renamed_traces = [
-        _replace_startswith(trace, f'  File "{filename}"', f'  File "{new_filename}"')
-        for trace in traces
-    ]
-    renamed_exception = [
-        _replace_startswith(e, f'  File "{filename}"', f'  File "{new_filename}"')
-        for e in format_exception_only(exception)
-    ]
-    return build_message(traces=renamed_traces, exception_list=renamed_exception)
+    from traceback import format_exception_only
+
+    kept, frame_count = _collapse(_user_traceback(traceback, filename))
+    kept, omitted, omitted_at = _limit(kept, head, tail)
+    message = (
+        exception.msg if isinstance(exception, SyntaxError) else _message(exception)
+    )
+    return {
+        "type": _type_name(exception),
+        "message": message,
+        "frames": _extract_frames(kept, filename, new_filename),
+        "exception": [
+            _replace_startswith(e, f'  File "{filename}"', f'  File "{new_filename}"')
+            for e in format_exception_only(exception)
+        ],
+        "frame_count": frame_count,
+        "omitted": omitted,
+        "omitted_at": omitted_at,
+    }
+
+
+def extract_exception(
+    *, exception, traceback, filename, new_filename=None, head=None, tail=None
+):
+    extracted = _extract(
+        exception=exception,
+        traceback=traceback,
+        filename=filename,
+        new_filename=new_filename,
+        head=head,
+        tail=tail,
+    )
+    extracted["frames"] = list(extracted["frames"])
+    return extracted
+
+
+# A snapshot has the same structure as an extracted exception, but nothing is
+# read from the source files until it's formatted. Instead, each frame has the
+# "source" file its line is looked up in, the first time it's formatted. Once
+# the snapshot is taken, the frames are cleared, which releases their local
+# variables (apart from frames that are still running, like the one handling
+# the exception). Nothing else holds on to the frames, so a snapshot can be kept
+# for as long as needed.
+
+
+def _position(code, lasti):
+    from itertools import islice
+
+    if lasti < 0 or not hasattr(code, "co_positions"):
+        return None, None, None, None
+    return next(islice(code.co_positions(), lasti // 2, None), (None,) * 4)
+
+
+def snapshot_exception(
+    *, exception, traceback, filename, new_filename=None, head=None, tail=None
+):
+    if new_filename is None:
+        new_filename = filename
+    import linecache
+    from traceback import clear_frames, format_exception_only
+
+    kept, frame_count = _collapse(_user_traceback(traceback, filename))
+    kept, omitted, omitted_at = _limit(kept, head, tail)
+    frames = []
+    for _, entry, repeated in kept:
+        code = entry.tb_frame.f_code
+        lineno, end_lineno, colno, end_colno = _position(code, entry.tb_lasti)
+        # Lets linecache find the lines of modules that were imported from
+        # zip files and the like.
+        linecache.lazycache(code.co_filename, entry.tb_frame.f_globals)
+        frames.append(
+            {
+                "filename": (
+                    new_filename if code.co_filename == filename else code.co_filename
+                ),
+                "lineno": entry.tb_lineno if lineno is None else lineno,
+                "function": code.co_name,
+                "end_lineno": end_lineno,
+                "colno": colno,
+                "end_colno": end_colno,
+                "repeated": repeated,
+                "source": code.co_filename,
+            }
+        )
+    message = (
+        exception.msg if isinstance(exception, SyntaxError) else _message(exception)
+    )
+    snapshot = {
+        "type": _type_name(exception),
+        "message": message,
+        "frames": frames,
+        "exception": [
+            _replace_startswith(e, f'  File "{filename}"', f'  File "{new_filename}"')
+            for e in format_exception_only(exception)
+        ],
+        "frame_count": frame_count,
+        "omitted": omitted,
+        "omitted_at": omitted_at,
+    }
+    clear_frames(traceback)
+    return snapshot
+
+
+def _resolve(frame):
+    if "line" not in frame:
+        lines = _source_lines(frame["source"], frame["lineno"], frame["end_lineno"])
+        frame["line"] = lines[0].strip() if lines else ""
+        frame["lines"] = lines
+    return frame
+
+
+# Python 3.13 shows all the lines of code that spans several lines, so it needs
+# all of them. Earlier versions only show the first line.
+
+
+def _summary_line(lines):
+    from traceback import FrameSummary
+
+    if not lines:
+        return ""
+    if hasattr(FrameSummary, "_dedented_lines"):
+        return "\n".join(line.rstrip() for line in lines) + "\n"
+    return lines[0]
+
+
+def _not_shown(count):
+    return f"  [{count} more frame{'s' if count != 1 else ''} not shown]\n"
+
+
+def _repeated(count):
+    return f"  [Previous line repeated {count} more time{'s' if count > 1 else ''}]\n"
+
+
+def format_extracted(extracted, max_size=None):
+    from traceback import FrameSummary, StackSummary
+
+    header = "Traceback (most recent call last):\n"
+    omitted = extracted.get("omitted", 0)
+    omitted_at = extracted.get("omitted_at", 0)
+    frame_count = extracted.get("frame_count", 0)
+    budget = None
+    if max_size is not None:
+        budget = max_size - len(header) - sum(map(len, extracted["exception"]))
+        # Leave room for the line saying how many frames were left out.
+        budget -= len(_not_shown(frame_count))
+
+    formatter = StackSummary()
+    traces = []
+    size = 0
+    shown = 0
+    for i, frame in enumerate(extracted["frames"]):
+        if omitted and i == omitted_at:
+            traces.append(_not_shown(omitted))
+            size += len(traces[-1])
+            shown += omitted
+        frame = _resolve(frame)
+        summary = FrameSummary(
+            frame["filename"],
+            frame["lineno"],
+            frame["function"],
+            lookup_line=False,
+            line=_summary_line(frame["lines"]),
+            end_lineno=frame["end_lineno"],
+            colno=frame["colno"],
+            end_colno=frame["end_colno"],
+        )
+        lines = formatter.format_frame_summary(summary)
+        repeated = frame.get("repeated", 0)
+        if repeated:
+            lines += _repeated(repeated)
+        if budget is not None and size + len(lines) > budget:
+            traces.append(_not_shown(frame_count - shown))
+            break
+        traces.append(lines)
+        size += len(lines)
+        shown += 1 + repeated
+    else:
+        if omitted and shown < frame_count:
+            traces.append(_not_shown(omitted))
+    return build_message(traces=traces, exception_list=extracted["exception"])
+
+
+# Writes extracted exceptions to a file, one JSON object per line, or as a
+# single JSON array with lines=False. Returns the number written.
+
+
+def write_exceptions(extracted, file, *, lines=True):
+    import json
+
+    if not lines:
+        extracted = list(extracted)
+        json.dump(extracted, file)
+        return len(extracted)
+    count = 0
+    for exception in extracted:
+        file.write(json.dumps(exception) + "\n")
+        count += 1
+    return count
+
+
+# Many submissions fail in the same way, so the formatted exceptions are cached
+# by a fingerprint of the exception and the code locations (and source lines)
+# of the frames that are shown. exception_counts returns how many times each
+# fingerprint has been formatted, so that repeated exceptions can be aggregated.
+# Only the MAX_COUNTED fingerprints formatted most recently are counted.
+
+MAX_FORMATTED = 256
+MAX_COUNTED = 4096
+
+_formatted = {}
+_counts = {}
+
+
+def fingerprint_exception(*, exception, traceback, filename, new_filename=None):
+    from hashlib import sha1
+    from traceback import format_exception_only
+
+    frames = []
+    # Each line is looked up once, however many times it's repeated.
+    lines = {}
+    traceback = _user_traceback(traceback, filename)
+    while traceback is not None:
+        code = traceback.tb_frame.f_code
+        lineno, end_lineno, _, _ = _position(code, traceback.tb_lasti)
+        location = (code.co_filename, lineno or traceback.tb_lineno, end_lineno)
+        if location not in lines:
+            lines[location] = _source_lines(*location)
+        frames.append((*location, code.co_name, traceback.tb_lasti))
+        traceback = traceback.tb_next
+    key = (
+        # These are the lines that end the traceback, which have everything
+        # about the exception that's shown, like its notes, the position of a
+        # SyntaxError or the suggestions of newer Python versions.
+        format_exception_only(exception),
+        filename,
+        new_filename,
+        frames,
+        lines,
+    )
+    return sha1(repr(key).encode("utf-8", "backslashreplace")).hexdigest()
+
+
+def _message(exception):
+    try:
+        return str(exception)
+    except Exception:
+        return None
+
+
+def exception_counts():
+    return dict(_counts)
+
+
+def clear_exception_cache():
+    _formatted.clear()
+    _counts.clear()
+
+
+def _format_exception(
+    *, exception, traceback, filename, new_filename, head, tail, max_size
+):
+    key = fingerprint_exception(
+        exception=exception,
+        traceback=traceback,
+        filename=filename,
+        new_filename=new_filename,
+    )
+    count = _counts.pop(key, 0) + 1
+    if len(_counts) >= MAX_COUNTED:
+        del _counts[next(iter(_counts))]
+    _counts[key] = count
+    cache_key = (key, head, tail, max_size)
+    formatted = _formatted.pop(cache_key, None)
+    if formatted is None:
+        extracted = _extract(
+            exception=exception,
+            traceback=traceback,
+            filename=filename,
+            new_filename=new_filename,
+            head=head,
+            tail=tail,
+        )
+        formatted = format_extracted(extracted, max_size)
+        if len(_formatted) >= MAX_FORMATTED:
+            del _formatted[next(iter(_formatted))]
+    _formatted[cache_key] = formatted
+    return formatted
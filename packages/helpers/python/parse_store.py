@@ -0,0 +1,161 @@
+# A persistent cache of parsed submissions, for regrading runs that would
+# otherwise parse the same sources again every time.
+#
+# Like batch.py, this is not part of the helpers that are loaded into Pyodide.
+# The store is a directory with two append-only files:
+#
+# - records: the compressed, pickled trees, one after the other. Each tree is
+#   stored with its body indexes, the canonical forms of its top-level
+#   statements and the structural hashes of its nodes, so the Nodes loaded from
+#   it don't have to compute them again. Nothing else that's cached on the
+#   tree is stored, so a source always gives the same record.
+# - index: a fixed-size entry per record with the SHA-256 of the source and
+#   the position of the record.
+#
+# The records file is memory-mapped, so only the records that are loaded are
+# read. A store should only be written to by one process at a time:
+#
+#   with ParseStore("/tmp/submissions") as store:
+#       node = store.load(source)  # parses and stores source the first time
+
+import ast
+import hashlib
+import io
+import mmap
+import os
+import pickle
+import struct
+import zlib
+
+from py_helpers import Node, _hashes, _index_body, _parse_cache, _tree_size
+
+_ENTRY = struct.Struct("<32sQQ")
+
+# Records start with a byte saying whether they are a tree or a SyntaxError.
+_TREE = b"T"
+_ERROR = b"E"
+
+# Besides their fields, the AST nodes are stored with what _precompute computes
+# for them: the hashes of every node, the body indexes of the module and the
+# canonical forms of its statements. Other helpers cache more on the shared
+# tree, which is left out, so that the record doesn't depend on which checks
+# ran before it was stored.
+
+
+class _Pickler(pickle.Pickler):
+    def __init__(self, file, tree):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self._stored = {id(tree): ("_body_indexes", "_node_hashes")}
+        for stmt in tree.body:
+            self._stored[id(stmt)] = ("_canonical_text", "_node_hashes")
+
+    def reducer_override(self, obj):
+        if isinstance(obj, ast.AST):
+            names = (*obj._fields, *obj._attributes)
+            names += self._stored.get(id(obj), ("_node_hashes",))
+            state = {name: obj.__dict__[name] for name in names if name in obj.__dict__}
+            return type(obj), (), state
+        return NotImplemented
+
+
+def _dumps(tree):
+    with io.BytesIO() as buffer:
+        _Pickler(buffer, tree).dump(tree)
+        return buffer.getvalue()
+
+
+def _key(source):
+    return hashlib.sha256(source.encode("utf-8", "surrogatepass")).digest()
+
+
+def _precompute(tree):
+    _index_body(tree)
+    _hashes(tree)
+    for stmt in tree.body:
+        Node(stmt)._canonical_str()
+
+
+class ParseStore:
+    def __init__(self, path):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self._records = open(os.path.join(path, "records"), "a+b")
+        self._index_file = open(os.path.join(path, "index"), "a+b")
+        self._index = {}
+        self._map = None
+        self._index_file.seek(0)
+        entries = self._index_file.read()
+        usable = len(entries) - len(entries) % _ENTRY.size
+        # Drops an entry that was only partly written, so the next ones line up.
+        if usable < len(entries):
+            self._index_file.truncate(usable)
+        for key, offset, length in _ENTRY.iter_unpack(entries[:usable]):
+            self._index[key] = (offset, length)
+
+    def __contains__(self, source):
+        return _key(source) in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._records.close()
+        self._index_file.close()
+
+    def _read(self, offset, length):
+        if self._map is None or len(self._map) < offset + length:
+            if self._map is not None:
+                self._map.close()
+            self._records.flush()
+            self._map = mmap.mmap(self._records.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map[offset : offset + length]
+
+    # Returns the stored Node for source, or None if it isn't stored. Sources
+    # that failed to parse raise the same SyntaxError as parsing them.
+
+    def get(self, source):
+        location = self._index.get(_key(source))
+        if location is None:
+            return None
+        record = zlib.decompress(self._read(*location))
+        if record[:1] == _ERROR:
+            error_type, args = pickle.loads(record[1:])
+            raise error_type(*args)
+        tree = pickle.loads(record[1:])
+        tree._source_text = source
+        _parse_cache.put(source, tree, size=_tree_size(source))
+        return Node(tree)
+
+    def put(self, source):
+        key = _key(source)
+        if key in self._index:
+            return
+        try:
+            tree = Node(source).tree
+        except SyntaxError as err:
+            record = _ERROR + pickle.dumps((type(err), err.args))
+        else:
+            _precompute(tree)
+            record = _TREE + _dumps(tree)
+        data = zlib.compress(record)
+        self._records.seek(0, os.SEEK_END)
+        offset = self._records.tell()
+        self._records.write(data)
+        self._records.flush()
+        self._index_file.write(_ENTRY.pack(key, offset, len(data)))
+        self._index_file.flush()
+        self._index[key] = (offset, len(data))
+
+    def load(self, source):
+        if source not in self:
+            self.put(source)
+        return self.get(source)
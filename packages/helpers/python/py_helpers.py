@@ -1,12 +1,824 @@
 import ast
+import zlib
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+# A bounded least-recently-used cache. Entries are evicted once there are more
+# than maxsize of them or, if maxbytes is set, once their combined size (as
+# reported to put) exceeds maxbytes.
+
+
+class _LRUCache:
+    def __init__(self, maxsize, maxbytes=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._bytes = 0
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        entry = self._data.get(key, _MISSING)
+        if entry is _MISSING:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._data.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, value, size=0):
+        if self.maxbytes is not None and size > self.maxbytes:
+            return
+        if key in self._data:
+            self._bytes -= self._data.pop(key)[1]
+        self._data[key] = (value, size)
+        self._bytes += size
+        while len(self._data) > self.maxsize or (
+            self.maxbytes is not None and self._bytes > self.maxbytes
+        ):
+            _key, (_value, evicted_size) = self._data.popitem(last=False)
+            self._bytes -= evicted_size
+            self.evictions += 1
+
+    def clear(self):
+        self._data.clear()
+        self._bytes = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def info(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": len(self._data),
+            "bytes": self._bytes,
+            "maxsize": self.maxsize,
+            "maxbytes": self.maxbytes,
+        }
+
+
+# Tests typically create a new Node(_code) for every assertion, so parsed trees
+# are cached by their source. The trees are shared between Nodes, which is safe
+# because none of the helpers modify them. SyntaxErrors are cached too, so that
+# a broken submission is only parsed once.
+#
+# A tree takes about 50 times as much memory as its source, before anything is
+# computed and stored on it, so the cache is charged that estimate rather than
+# the length of the source.
+
+_TREE_BYTES_PER_CHAR = 50
+
+_parse_cache = _LRUCache(maxsize=64, maxbytes=32 * 1024 * 1024)
+
+
+def _tree_size(source):
+    return len(source) * _TREE_BYTES_PER_CHAR
+
+
+# The strings that tests compare against are the same for every submission, so
+# their canonical forms (see is_equivalent) are cached too.
+
+_canonical_cache = _LRUCache(maxsize=1024, maxbytes=1024 * 1024)
+
+# Compiled patterns (see compile_pattern) are cached by their source.
+
+_pattern_cache = _LRUCache(maxsize=256)
+
+# The argument strings passed to has_args are parsed into signatures once. They
+# have their own cache so that they don't take the place of submissions in the
+# parse cache.
+
+_args_cache = _LRUCache(maxsize=256)
+
+_caches = {
+    "parse": _parse_cache,
+    "canonical": _canonical_cache,
+    "pattern": _pattern_cache,
+    "args": _args_cache,
+}
+
+
+def _parse(source):
+    result = _parse_cache.get(source, _MISSING)
+    if result is _MISSING:
+        try:
+            result = ast.parse(source)
+            result._source_text = source
+        except SyntaxError as err:
+            result = err
+        _parse_cache.put(source, result, size=_tree_size(source))
+    if isinstance(result, SyntaxError):
+        # A fresh copy, so that repeated failures don't share a traceback.
+        raise type(result)(*result.args)
+    return result
+
+
+# Parses source, which is an edited version of the source of tree, reusing the
+# top-level statements of tree that are on lines that weren't changed. The
+# statements after the edit are only reused if the edit didn't add or remove
+# lines, since their line numbers would otherwise be wrong. Anything that can't
+# be parsed on its own falls back to parsing the whole source.
+
+
+def _first_line(stmt):
+    return min([stmt.lineno] + [dec.lineno for dec in stmt.decorator_list])
+
+
+# Splits source into lines the way the tokenizer does. str.splitlines also
+# splits on characters like form feeds and "\u2028", which don't end lines.
+
+
+def _split_lines(source):
+    lines = []
+    pending = ""
+    for piece in source.splitlines(keepends=True):
+        pending += piece
+        if pending.endswith(("\n", "\r")):
+            lines.append(pending)
+            pending = ""
+    if pending:
+        lines.append(pending)
+    return lines
+
+
+def _reparse(tree, old_source, source):
+    old_lines = _split_lines(old_source)
+    new_lines = _split_lines(source)
+    limit = min(len(old_lines), len(new_lines))
+    prefix = 0
+    while prefix < limit and old_lines[prefix] == new_lines[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and old_lines[-1 - suffix] == new_lines[-1 - suffix]:
+        suffix += 1
+
+    body = tree.body
+    starts = [
+        _first_line(stmt) if hasattr(stmt, "decorator_list") else stmt.lineno
+        for stmt in body
+    ]
+    # A statement can only be reused if it doesn't share a line with the
+    # statement next to it (e.g. "x = 1; y = 2").
+    head = 0
+    while (
+        head < len(body)
+        and body[head].end_lineno <= prefix
+        and (head + 1 == len(body) or starts[head + 1] > body[head].end_lineno)
+    ):
+        head += 1
+    tail = len(body)
+    if len(new_lines) == len(old_lines):
+        first_unchanged = len(old_lines) - suffix + 1
+        while (
+            tail > head
+            and starts[tail - 1] >= first_unchanged
+            and (tail - 1 == head or body[tail - 2].end_lineno < starts[tail - 1])
+        ):
+            tail -= 1
+
+    start = body[head - 1].end_lineno if head else 0
+    end = starts[tail] - 1 if tail < len(body) else len(new_lines)
+    try:
+        middle = ast.parse("".join(new_lines[start:end])).body
+    except SyntaxError:
+        return _parse(source)
+    for stmt in middle:
+        ast.increment_lineno(stmt, start)
+    return ast.Module(body[:head] + middle + body[tail:], [])
+
+
+def _canonical_form(source):
+    canonical = _canonical_cache.get(source)
+    if canonical is None:
+        canonical = ast.unparse(ast.parse(source))
+        _canonical_cache.put(source, canonical, size=len(source) + len(canonical))
+    return canonical
+
+
+# Merkle-style hashes of a tree: one ignoring and one including the location
+# attributes. They're computed bottom-up the first time they're needed and
+# stored on the AST nodes themselves, so they're shared by every Node that
+# wraps (part of) the same tree. Strings and types are hashed with CRC-32
+# rather than hash(), which changes between processes, so that the hashes
+# stay valid for trees that are pickled and loaded in another process.
+
+
+def _stable_hash(string):
+    return zlib.crc32(string.encode("utf-8", "surrogatepass"))
+
+
+_type_hashes = {}
+
+
+def _type_hash(node_type):
+    hashed = _type_hashes.get(node_type)
+    if hashed is None:
+        hashed = _type_hashes[node_type] = _stable_hash(node_type.__qualname__)
+    return hashed
+
+
+def _hashes(value):
+    if isinstance(value, ast.AST):
+        hashes = value.__dict__.get("_node_hashes")
+        if hashes is None:
+            children = [_hashes(getattr(value, field, None)) for field in value._fields]
+            attributes = [getattr(value, attr, None) for attr in value._attributes]
+            node_type = _type_hash(type(value))
+            hashes = (
+                hash((node_type, *(child[0] for child in children))),
+                hash(
+                    (
+                        node_type,
+                        *(child[1] for child in children),
+                        *(-1 if attr is None else attr for attr in attributes),
+                    )
+                ),
+            )
+            value._node_hashes = hashes
+        return hashes
+    if isinstance(value, list):
+        pairs = [_hashes(item) for item in value]
+        return (
+            hash(tuple(pair[0] for pair in pairs)),
+            hash(tuple(pair[1] for pair in pairs)),
+        )
+    # Constants are hashed by their repr, as that's what ast.dump compares.
+    hashed = _stable_hash(value if isinstance(value, str) else repr(value))
+    return hashed, hashed
+
+
+# Equivalent to comparing the ast.dump of a and b, with or without attributes,
+# but subtrees with different hashes are rejected without being visited.
+
+
+def _structurally_equal(a, b, located):
+    if a is b:
+        return True
+    if isinstance(a, ast.AST):
+        if type(a) is not type(b):
+            return False
+        index = 1 if located else 0
+        if _hashes(a)[index] != _hashes(b)[index]:
+            return False
+        if located and any(
+            getattr(a, attr, None) != getattr(b, attr, None) for attr in a._attributes
+        ):
+            return False
+        return all(
+            _structurally_equal(
+                getattr(a, field, None), getattr(b, field, None), located
+            )
+            for field in a._fields
+        )
+    if isinstance(a, list):
+        return (
+            isinstance(b, list)
+            and len(a) == len(b)
+            and all(_structurally_equal(x, y, located) for x, y in zip(a, b))
+        )
+    if isinstance(b, (ast.AST, list)):
+        return False
+    return type(a) is type(b) and repr(a) == repr(b)
+
+
+# Indexes of tree.body, built in a single pass and stored on the tree like the
+# hashes above. The type index maps each node type to the positions of the
+# statements of that type. The symbol index maps the names of the functions,
+# classes and variables defined in the body to the first statement that defines
+# them.
+
+
+def _assigned_name(target):
+    if isinstance(target, ast.Name):
+        return target.id
+    if isinstance(target, ast.Attribute) and isinstance(target.value, ast.Name):
+        return f"{target.value.id}.{target.attr}"
+    return None
+
+
+def _index_body(tree):
+    indexes = tree.__dict__.get("_body_indexes")
+    if indexes is None:
+        types = {}
+        symbols = {
+            "function": {},
+            "async_function": {},
+            "class": {},
+            "variable": {},
+            "aug_variable": {},
+        }
+        for i, node in enumerate(tree.body):
+            types.setdefault(type(node), []).append(i)
+            if isinstance(node, ast.FunctionDef):
+                symbols["function"].setdefault(node.name, node)
+            elif isinstance(node, ast.AsyncFunctionDef):
+                symbols["async_function"].setdefault(node.name, node)
+            elif isinstance(node, ast.ClassDef):
+                symbols["class"].setdefault(node.name, node)
+            elif isinstance(node, ast.Assign):
+                for target in node.targets:
+                    if name := _assigned_name(target):
+                        symbols["variable"].setdefault(name, node)
+            elif isinstance(node, ast.AnnAssign):
+                if isinstance(node.target, ast.Name):
+                    symbols["variable"].setdefault(node.target.id, node)
+            elif isinstance(node, ast.AugAssign):
+                if isinstance(node.target, ast.Name):
+                    symbols["aug_variable"].setdefault(node.target.id, node)
+        indexes = tree._body_indexes = {"types": types, "symbols": symbols}
+    return indexes
+
+
+def _body_index(tree):
+    return _index_body(tree)["types"]
+
+
+def _symbol_index(tree):
+    return _index_body(tree)["symbols"]
+
+
+# The tree index maps each node type to all the nodes of that type in the whole
+# tree, in source order.
+
+
+def _tree_index(tree):
+    index = tree.__dict__.get("_tree_index")
+    if index is None:
+        index = {type(tree): [tree]}
+        for node in _iter_descendants(tree):
+            index.setdefault(type(node), []).append(node)
+        tree._tree_index = index
+    return index
+
+
+# The usage index is built from the tree index and has the names and
+# attributes that are loaded anywhere in the tree, and the calls in the tree
+# (in source order) by the name of the function or method that's called.
+
+
+def _usage_index(tree):
+    index = tree.__dict__.get("_usage_index")
+    if index is None:
+        nodes = _tree_index(tree)
+        loads = set()
+        for node in nodes.get(ast.Name, []):
+            if isinstance(node.ctx, ast.Load):
+                loads.add(node.id)
+        for node in nodes.get(ast.Attribute, []):
+            if isinstance(node.ctx, ast.Load):
+                loads.add(node.attr)
+        calls = {}
+        for node in nodes.get(ast.Call, []):
+            if isinstance(node.func, ast.Name):
+                calls.setdefault(node.func.id, []).append(node)
+            elif isinstance(node.func, ast.Attribute):
+                calls.setdefault(node.func.attr, []).append(node)
+        index = tree._usage_index = {"loads": loads, "calls": calls}
+    return index
+
+
+# The signature of a function is stored on its node and has its arguments
+# (positional, keyword-only, defaults, annotations, *args and **kwargs) as the
+# dump of the arguments node, which ignores formatting like is_equivalent does,
+# and the canonical form of its return annotation. The signatures of argument
+# strings are stored on the cached parse of a function with those arguments.
+
+
+def _arguments_key(arguments):
+    signature = arguments.__dict__.get("_signature")
+    if signature is None:
+        signature = arguments._signature = ast.dump(arguments)
+    return signature
+
+
+def _signature(function):
+    returns = None
+    if function.returns is not None:
+        returns = Node(function.returns)._canonical_str()
+    return {"args": _arguments_key(function.args), "returns": returns}
+
+
+def _args_signature(arg_str):
+    signature = _args_cache.get(arg_str)
+    if signature is None:
+        tree = ast.parse(f"def _({arg_str}):\n  pass")
+        signature = _arguments_key(tree.body[0].args)
+        _args_cache.put(arg_str, signature)
+    return signature
+
+
+# The canonical indexes map the canonical forms (see Node.is_equivalent) of
+# parts of the statements in tree.body to their positions, so that looking a
+# string up doesn't compare it with every statement. Each kind of index is only
+# built when it's first needed:
+#
+# - "stmts": the statements themselves, to all their positions.
+# - "ifs" and "whiles": the conditions of if statements and while loops, to the
+#   first position.
+# - "fors": the (target, iterable) pairs of for loops, to the first position.
+
+
+def _canonical_key(kind, node):
+    if kind == "stmts":
+        return Node(node)._canonical_str()
+    if kind == "fors":
+        return Node(node.target)._canonical_str(), Node(node.iter)._canonical_str()
+    return Node(node.test)._canonical_str()
+
+
+_CANONICAL_KINDS = {
+    "stmts": ast.stmt,
+    "ifs": ast.If,
+    "whiles": ast.While,
+    "fors": ast.For,
+}
+
+
+def _canonical_index(tree, kind):
+    indexes = tree.__dict__.get("_canonical_indexes")
+    if indexes is None:
+        indexes = tree._canonical_indexes = {}
+    index = indexes.get(kind)
+    if index is None:
+        index = {}
+        node_type = _CANONICAL_KINDS[kind]
+        for i, node in enumerate(tree.body):
+            if isinstance(node, node_type):
+                key = _canonical_key(kind, node)
+                if kind == "stmts":
+                    index.setdefault(key, []).append(i)
+                else:
+                    index.setdefault(key, i)
+        indexes[kind] = index
+    return index
+
+
+# A lazy, pre-order (i.e. source order) walk of everything below tree.
+
+
+def _iter_descendants(tree):
+    stack = list(ast.iter_child_nodes(tree))[::-1]
+    while stack:
+        node = stack.pop()
+        yield node
+        stack.extend(list(ast.iter_child_nodes(node))[::-1])
+
+
+# Statement lists (e.g. the body of a function) are wrapped in a Module. The
+# Module is created once per list, so that its indexes are reused.
+
+
+def _module(owner, field):
+    modules = owner.__dict__.setdefault("_modules", {})
+    if field not in modules:
+        modules[field] = ast.Module(getattr(owner, field), [])
+    return modules[field]
+
+
+# Structural patterns are written in Python, with placeholders in place of the
+# parts that can vary:
+#
+# - `__any__` matches any expression and `__x__` (any other dunder name)
+#   matches any expression and captures it. A placeholder that's used more
+#   than once has to match the same code each time. Placeholders also work as
+#   identifiers, e.g. `def __f__(__arg__): ...`.
+# - `*__x__` in a list of arguments or elements and `**__x__` in a list of
+#   keyword arguments match zero or more of them.
+# - `...` as a statement matches zero or more statements.
+#
+# Names that Python gives a meaning to, like `__init__` or `__name__`, are not
+# placeholders. Patterns are compiled to a tree of matching functions once and
+# then matched directly against the AST, ignoring locations and contexts.
+
+# The special names are the dunders of a few builtin types and a hand-picked
+# list of other common ones. Any dunder that's not in it, like `__author__` or
+# `__match_args__`, is taken as a placeholder, so add names here when patterns
+# need to match them literally.
+
+_SPECIAL_NAMES = {
+    name for cls in (object, type, int, list, dict, BaseException) for name in dir(cls)
+} | {
+    "__aenter__",
+    "__aexit__",
+    "__aiter__",
+    "__all__",
+    "__anext__",
+    "__annotations__",
+    "__await__",
+    "__builtins__",
+    "__call__",
+    "__debug__",
+    "__delete__",
+    "__enter__",
+    "__exit__",
+    "__file__",
+    "__future__",
+    "__get__",
+    "__loader__",
+    "__main__",
+    "__missing__",
+    "__next__",
+    "__package__",
+    "__path__",
+    "__post_init__",
+    "__set__",
+    "__slots__",
+    "__spec__",
+    "__version__",
+}
+
+
+def _placeholder(name):
+    if (
+        isinstance(name, str)
+        and len(name) > 4
+        and name.startswith("__")
+        and name.endswith("__")
+        and name not in _SPECIAL_NAMES
+    ):
+        return name[2:-2]
+    return None
+
+
+# Captures are compared as code, so that an identifier captured from a
+# parameter or a target can be matched again where it's used.
+
+
+def _capture_key(value):
+    if isinstance(value, list):
+        return [_capture_key(item) for item in value]
+    if isinstance(value, ast.AST):
+        return ast.unparse(value)
+    return value
+
+
+def _bind(name, value, captures):
+    if name == "any":
+        return True
+    if name in captures:
+        return _capture_key(captures[name]) == _capture_key(value)
+    captures[name] = value
+    return True
+
+
+def _compile_capture(name):
+    def match(value, captures):
+        return value is not None and _bind(name, value, captures)
+
+    return match
+
+
+def _list_wildcard(pattern):
+    if isinstance(pattern, ast.Expr) and isinstance(pattern.value, ast.Constant):
+        if pattern.value.value is Ellipsis:
+            return "any"
+    if isinstance(pattern, ast.Starred) and isinstance(pattern.value, ast.Name):
+        return _placeholder(pattern.value.id)
+    if isinstance(pattern, ast.keyword) and pattern.arg is None:
+        if isinstance(pattern.value, ast.Name):
+            return _placeholder(pattern.value.id)
+    return None
+
+
+def _match_sequence(items, values, i, j, captures):
+    if i == len(items):
+        return j == len(values)
+    wildcard, matcher = items[i]
+    if wildcard is None:
+        return (
+            j < len(values)
+            and matcher(values[j], captures)
+            and _match_sequence(items, values, i + 1, j + 1, captures)
+        )
+    for end in range(j, len(values) + 1):
+        saved = dict(captures)
+        if _bind(wildcard, values[j:end], captures) and _match_sequence(
+            items, values, i + 1, end, captures
+        ):
+            return True
+        captures.clear()
+        captures.update(saved)
+    return False
+
+
+def _compile_list(patterns):
+    items = [
+        (
+            (wildcard, None)
+            if (wildcard := _list_wildcard(item))
+            else (None, _compile(item))
+        )
+        for item in patterns
+    ]
+    if all(wildcard is None for wildcard, _matcher in items):
+        matchers = [matcher for _wildcard, matcher in items]
+
+        def match(values, captures):
+            return (
+                isinstance(values, list)
+                and len(values) == len(matchers)
+                and all(m(value, captures) for m, value in zip(matchers, values))
+            )
+
+        return match
+
+    def match(values, captures):
+        return isinstance(values, list) and _match_sequence(
+            items, values, 0, 0, captures
+        )
+
+    return match
+
+
+def _compile(pattern):
+    if isinstance(pattern, ast.Name) and (name := _placeholder(pattern.id)):
+        return _compile_capture(name)
+    if isinstance(pattern, ast.Constant):
+        value = pattern.value
+
+        def match(node, captures):
+            return (
+                isinstance(node, ast.Constant)
+                and type(node.value) is type(value)
+                and node.value == value
+            )
+
+        return match
+    if isinstance(pattern, ast.AST):
+        node_type = type(pattern)
+        fields = [
+            (field, _compile(getattr(pattern, field, None)))
+            for field in pattern._fields
+            if field != "ctx"
+        ]
+
+        def match(node, captures):
+            return type(node) is node_type and all(
+                matcher(getattr(node, field, None), captures)
+                for field, matcher in fields
+            )
+
+        return match
+    if isinstance(pattern, list):
+        return _compile_list(pattern)
+    if name := _placeholder(pattern):
+        return _compile_capture(name)
+    return lambda value, captures: value == pattern
+
+
+class _Pattern:
+    def __init__(self, source):
+        tree = ast.parse(source)
+        if len(tree.body) != 1:
+            raise ValueError("A pattern must be a single statement or expression")
+        root = tree.body[0]
+        if isinstance(root, ast.Expr):
+            root = root.value
+        self.source = source
+        # Used to look up the candidates for a match in the tree index.
+        self.node_type = None if _placeholder(getattr(root, "id", None)) else type(root)
+        self._match = _compile(root)
+
+    def match(self, tree):
+        captures = {}
+        if not self._match(tree, captures):
+            return None
+        return {name: _wrap_capture(value) for name, value in captures.items()}
+
+
+def _wrap_capture(value):
+    if isinstance(value, list):
+        return [_wrap_capture(item) for item in value]
+    if isinstance(value, ast.AST):
+        return Node(value)
+    return value
+
+
+def compile_pattern(pattern):
+    if isinstance(pattern, _Pattern):
+        return pattern
+    compiled = _pattern_cache.get(pattern)
+    if compiled is None:
+        compiled = _Pattern(pattern)
+        _pattern_cache.put(pattern, compiled)
+    return compiled
+
+
+def _node_method(name):
+    method = getattr(Node, name, None) if not name.startswith("_") else None
+    if not callable(method):
+        raise ValueError(f"Unknown check: {name}")
+    return method
+
+
+# A test plan runs a set of checks that are written as chains of steps. Each
+# step is either a Node method name with its arguments or an index into the
+# previous result:
+#
+# plan = compile_plan([
+#   [("find_function", "foo"), ("find_body",), ("has_call", "bar()")],
+#   [("find_function", "foo"), ("find_body",), ("has_variable", "x")],
+#   [("find_ifs",), 0, ("find_conditions",), 0, ("is_equivalent", "x > 0")],
+#   ("has_import", "import math"),
+# ])
+# plan.run(Node(_code)) # [True, False, True, True]
+#
+# The chains are merged into a tree, so a prefix that's shared by several
+# checks, like find_function("foo").find_body() above, is only evaluated once
+# per Node. Plans only contain names, numbers and strings, so they can be saved
+# with to_json and compiled again from json.loads(plan_json).
+
+
+def _freeze(value):
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def _plan_step(step):
+    if isinstance(step, int):
+        return step
+    name, *args = step
+    _node_method(name)
+    return (name, *_freeze(args))
+
+
+class _Plan:
+    def __init__(self, checks):
+        self.checks = []
+        # Each node of the tree is a pair of its children (keyed by step) and
+        # the positions of the checks that end there.
+        self._root = ({}, [])
+        for position, check in enumerate(checks):
+            if isinstance(check[0], str):
+                check = [check]
+            steps = [_plan_step(step) for step in check]
+            self.checks.append(steps)
+            node = self._root
+            for step in steps:
+                node = node[0].setdefault(step, ({}, []))
+            node[1].append(position)
+
+    def run(self, node):
+        results = [None] * len(self.checks)
+        self._run(self._root, node, results)
+        return results
+
+    def _run(self, plan_node, value, results):
+        children, positions = plan_node
+        for position in positions:
+            results[position] = value
+        for step, child in children.items():
+            # A step that can't navigate any further, like indexing past the
+            # end of an empty list or calling a method on a Node without a
+            # tree, leaves None as the result of the checks below it, without
+            # affecting the others. Other errors, like a wrong number of
+            # arguments, are raised as they are by check_all.
+            try:
+                if isinstance(step, int):
+                    result = value[step]
+                else:
+                    name, *args = step
+                    result = getattr(value, name)(*args)
+            except (IndexError, AttributeError):
+                continue
+            self._run(child, result, results)
+
+    def to_json(self):
+        import json
+
+        return json.dumps(self.checks)
+
+
+def compile_plan(checks):
+    return checks if isinstance(checks, _Plan) else _Plan(checks)
+
+
+def cache_info():
+    return {name: cache.info() for name, cache in _caches.items()}
+
+
+def clear_caches():
+    for cache in _caches.values():
+        cache.clear()
+
 
 # A chainable class that allows us to call functions on the result of parsing a string
 
 
 class Node:
+    # Nodes are created for every intermediate result, so they use slots to
+    # keep the per-Node cache of their unparsed and canonical strings cheap.
+    __slots__ = ("tree", "_source", "_canonical")
+
     def __init__(self, tree=None):
+        self._source = None
+        self._canonical = None
         if isinstance(tree, str):
-            self.tree = ast.parse(tree)
+            self.tree = _parse(tree)
         elif isinstance(tree, ast.AST) or tree == None:
             self.tree = tree
         else:
@@ -36,9 +848,12 @@ class Node:
             return other.tree == None
         if other.tree == None:
             return False
-        return ast.dump(self.tree, include_attributes=True) == ast.dump(
-            other.tree, include_attributes=True
-        )
+        return _structurally_equal(self.tree, other.tree, located=True)
+
+    def __hash__(self):
+        if self.tree == None:
+            return hash(None)
+        return _hashes(self.tree)[1]
 
     def __repr__(self):
         if self.tree == None:
@@ -48,7 +863,28 @@ class Node:
     def __str__(self):
         if self.tree == None:
             return "# no ast"
-        return ast.unparse(self.tree)
+        if self._source is None:
+            self._source = ast.unparse(self.tree)
+        return self._source
+
+    # Returns a Node for source, which is expected to be an edited version of
+    # the code this Node was created from. The top-level statements that were
+    # not edited are reused, along with their hashes and indexes, so checks can
+    # be re-run cheaply while the learner types.
+
+    def reparse(self, source):
+        old_source = getattr(self.tree, "_source_text", None)
+        if old_source is None or not isinstance(self.tree, ast.Module):
+            return Node(source)
+        if old_source == source:
+            return Node(self.tree)
+        cached = _parse_cache.get(source)
+        if isinstance(cached, ast.Module):
+            return Node(cached)
+        tree = _reparse(self.tree, old_source, source)
+        tree._source_text = source
+        _parse_cache.put(source, tree, size=_tree_size(source))
+        return Node(tree)
 
     def _has_body(self):
         return bool(getattr(self.tree, "body", False))
@@ -57,93 +893,85 @@ class Node:
     # function. In this case, it returns a new node with the function
     # definition (if it exists)
 
-    def find_function(self, func):
+    def _find_symbol(self, kind, name):
         if not self._has_body():
             return Node()
-        for node in self.tree.body:
-            if isinstance(node, ast.FunctionDef):
-                if node.name == func:
-                    return Node(node)
-        return Node()
+        node = _symbol_index(self.tree)[kind].get(name)
+        return Node() if node is None else Node(node)
+
+    def _has_symbol(self, kind, name):
+        return self._has_body() and name in _symbol_index(self.tree)[kind]
+
+    def find_function(self, func):
+        return self._find_symbol("function", func)
+
+    # "iter" functions are lazy versions of the "find" functions that return
+    # a list. They only create Nodes as they're needed, so checks like
+    # any(...) or next(...) stop as soon as they have an answer. With
+    # recursive=True they also search nested blocks.
+
+    def iter_functions(self, func, recursive=False):
+        for node in self._iter_nodes(
+            (ast.FunctionDef, ast.AsyncFunctionDef), recursive
+        ):
+            if node.name == func:
+                yield Node(node)
 
     def find_functions(self, func):
-        return [
-            node
-            for node in self._find_all((ast.FunctionDef, ast.AsyncFunctionDef))
-            if node.tree.name == func
-        ]
+        return list(self.iter_functions(func))
 
     def find_async_function(self, func):
-        if not self._has_body():
-            return Node()
-        for node in self.tree.body:
-            if isinstance(node, ast.AsyncFunctionDef):
-                if node.name == func:
-                    return Node(node)
-        return Node()
+        return self._find_symbol("async_function", func)
+
+    def iter_awaits(self, recursive=False):
+        for node in self._iter_nodes(ast.Expr, recursive):
+            if isinstance(node.value, ast.Await):
+                yield Node(node)
 
     def find_awaits(self):
-        return [
-            node
-            for node in self._find_all(ast.Expr)
-            if isinstance(node.tree.value, ast.Await)
-        ]
+        return list(self.iter_awaits())
 
     def has_args(self, arg_str):
         if not isinstance(self.tree, (ast.FunctionDef, ast.AsyncFunctionDef)):
             return False
-        dec_list = (f"@{Node(node)}" for node in self.tree.decorator_list)
-        dec_str = "\n".join(dec_list) + "\n" if dec_list else ""
-        if id := getattr(self.tree.returns, "id", False):
-            returns = f" -> {id}"
-        elif hasattr(self.tree.returns, "value"):
-            returns = f" -> {self.tree.returns.value}"
-        else:
-            returns = ""
-        async_kw = ""
-        if isinstance(self.tree, ast.AsyncFunctionDef):
-            async_kw = "async "
-        body_lines = str(self.find_body()).split("\n")
-        new_body = "".join([f"\n  {line}" for line in body_lines])
-        func_str = (
-            f"{dec_str}{async_kw}def {self.tree.name}({arg_str}){returns}:{new_body}"
-        )
-        return self.is_equivalent(func_str)
+        return _signature(self.tree)["args"] == _args_signature(arg_str)
 
     # returns_str is the annotation of the type returned by the function
     def has_returns(self, returns_str):
         if not isinstance(self.tree, (ast.FunctionDef, ast.AsyncFunctionDef)):
             return False
-        return Node(self.tree.returns).is_equivalent(returns_str)
+        returns = _signature(self.tree)["returns"]
+        return returns is not None and returns == _canonical_form(returns_str)
 
     def find_body(self):
         if not isinstance(self.tree, ast.AST):
             return Node()
         if not hasattr(self.tree, "body"):
             return Node()
-        return Node(ast.Module(self.tree.body, []))
+        return Node(_module(self.tree, "body"))
 
     # find the return statement of a function
     def find_return(self):
-        if return_list := self._find_all(ast.Return):
-            return return_list[0]
-        return Node()
+        return next(self._iter_all(ast.Return), Node())
 
     def has_return(self, return_value):
         return self.find_return().is_equivalent(f"return {return_value}")
 
+    def iter_imports(self, recursive=False):
+        return self._iter_all((ast.Import, ast.ImportFrom), recursive)
+
     def find_imports(self):
-        return self._find_all((ast.Import, ast.ImportFrom))
+        return list(self.iter_imports())
 
-    def find_comps(self):
-        return [
-            node
-            for node in self._find_all(ast.Expr)
+    def iter_comps(self, recursive=False):
+        for node in self._iter_nodes(ast.Expr, recursive):
             if isinstance(
-                node.tree.value,
-                (ast.ListComp, ast.SetComp, ast.GeneratorExp, ast.DictComp),
-            )
-        ]
+                node.value, (ast.ListComp, ast.SetComp, ast.GeneratorExp, ast.DictComp)
+            ):
+                yield Node(node)
+
+    def find_comps(self):
+        return list(self.iter_comps())
 
     def _find_comp(
         self, classes=(ast.ListComp, ast.SetComp, ast.GeneratorExp, ast.DictComp)
@@ -197,38 +1025,39 @@ class Node:
     # searched for exists. In this case, it returns True if the variable exists.
 
     def has_variable(self, name):
-        return self.find_variable(name) != Node()
+        return self._has_symbol("variable", name)
 
     def has_import(self, import_str):
-        return any(
-            import_node.is_equivalent(import_str) for import_node in self.find_imports()
-        )
+        return self._has_stmt_of_type(import_str, (ast.Import, ast.ImportFrom))
 
     # find a list of function calls of the 'name' function
-    def find_calls(self, name):
-        call_list = []
-        for node in self._find_all(ast.Expr):
-            if func := getattr(node.tree.value, "func", False):
+    # With recursive=True, this finds every call in the tree, including the
+    # ones in assignments, return statements and the arguments of other calls.
+
+    def iter_calls(self, name, recursive=False):
+        if recursive:
+            if self.tree == None:
+                return
+            for node in _usage_index(self.tree)["calls"].get(name, []):
+                yield Node(node)
+            return
+        for node in self._iter_nodes(ast.Expr):
+            if func := getattr(node.value, "func", False):
                 if isinstance(func, ast.Name) and func.id == name:
-                    call_list.append(Node(node.tree.value))
+                    yield Node(node.value)
                 elif isinstance(func, ast.Attribute) and func.attr == name:
-                    call_list.append(Node(node.tree.value))
-        return call_list
+                    yield Node(node.value)
+
+    def find_calls(self, name, recursive=False):
+        return list(self.iter_calls(name, recursive))
 
     def has_call(self, call):
-        return any(node.is_equivalent(call) for node in self._find_all(ast.Expr))
+        return self._has_stmt_of_type(call, ast.Expr)
 
     def block_has_call(self, name, function=None):
         body = self if function is None else self.find_function(function).find_body()
         if body:
-            for node in ast.walk(body.tree):
-                fields = node._fields
-                for n, field in enumerate(fields):
-                    if field == "attr" or field == "id" and fields[n + 1] == "ctx":
-                        if getattr(node, field, None) == name and isinstance(
-                            getattr(node, fields[n + 1], None), ast.Load
-                        ):
-                            return True
+            return name in _usage_index(body.tree)["loads"]
         return False
 
     def find_call_args(self):
@@ -239,56 +1068,34 @@ class Node:
     def has_stmt(self, node_str):
         if not self._has_body():
             return False
-        return any(Node(node).is_equivalent(node_str) for node in self.tree.body)
+        return _canonical_form(node_str) in _canonical_index(self.tree, "stmts")
 
-    def find_variable(self, name):
+    # Like has_stmt, but only for statements of the given type(s).
+
+    def _has_stmt_of_type(self, node_str, stmt_type):
         if not self._has_body():
-            return Node()
-        for node in self.tree.body:
+            return False
+        index = _canonical_index(self.tree, "stmts")
+        positions = index.get(_canonical_form(node_str), [])
+        return any(isinstance(self.tree.body[i], stmt_type) for i in positions)
+
+    def find_variable(self, name):
+        return self._find_symbol("variable", name)
+
+    def iter_variables(self, name, recursive=False):
+        for node in self._iter_nodes((ast.Assign, ast.AnnAssign), recursive):
             if isinstance(node, ast.Assign):
-                for target in node.targets:
-                    if isinstance(target, ast.Name):
-                        if target.id == name:
-                            return Node(node)
-                    if isinstance(target, ast.Attribute):
-                        names = name.split(".")
-                        if target.value.id == names[0] and target.attr == names[1]:
-                            return Node(node)
-            elif isinstance(node, ast.AnnAssign):
-                if isinstance(node.target, ast.Name):
-                    if node.target.id == name:
-                        return Node(node)
-        return Node()
+                if any(_assigned_name(target) == name for target in node.targets):
+                    yield Node(node)
+            elif isinstance(node.target, ast.Name) and node.target.id == name:
+                yield Node(node)
 
     def find_variables(self, name):
-        assignments = self._find_all((ast.Assign, ast.AnnAssign))
-        var_list = []
-        for node in assignments:
-            if isinstance(node.tree, ast.Assign):
-                for target in node.tree.targets:
-                    if isinstance(target, ast.Name):
-                        if target.id == name:
-                            var_list.append(node)
-                    if isinstance(target, ast.Attribute):
-                        names = name.split(".")
-                        if target.value.id == names[0] and target.attr == names[1]:
-                            var_list.append(node)
-            elif isinstance(node.tree, ast.AnnAssign):
-                if isinstance(node.tree.target, ast.Name):
-                    if node.tree.target.id == name:
-                        var_list.append(node)
-        return var_list
+        return list(self.iter_variables(name))
 
     # find variable incremented or decremented using += or -=
     def find_aug_variable(self, name):
-        if not self._has_body():
-            return Node()
-        for node in self.tree.body:
-            if isinstance(node, ast.AugAssign):
-                if isinstance(node.target, ast.Name):
-                    if node.target.id == name:
-                        return Node(node)
-        return Node()
+        return self._find_symbol("aug_variable", name)
 
     def get_variable(self, name):
         var = self.find_variable(name)
@@ -298,10 +1105,10 @@ class Node:
             return None
 
     def has_function(self, name):
-        return self.find_function(name) != Node()
+        return self._has_symbol("function", name)
 
     def has_class(self, name):
-        return self.find_class(name) != Node()
+        return self._has_symbol("class", name)
 
     def has_decorators(self, *args):
         # the order of args does matter
@@ -353,16 +1160,94 @@ class Node:
         # equivalent to any string.
         if self.tree == None:
             return False
-        code_str = ast.unparse(self.tree)
+        return self._canonical_str() == _canonical_form(target_str)
+
+    # The canonical string is also stored on the AST node, so that it's shared
+    # with the other Nodes that wrap it (and can be stored with the tree).
+
+    def _canonical_str(self):
+        if self._canonical is None:
+            self._canonical = self.tree.__dict__.get("_canonical_text")
+        if self._canonical is None:
+            # Why parse and unparse again? Because of an edge case when
+            # comparing the `target_str` "'True'" with the test in "if 'True':".
+            # These should be equivalent, but the condition unparses to
+            # "'True'", while the `target_str` becomes '"""True"""' when parsed
+            # and unparsed again.
+
+            # By parsing and unparsing the code we get '"""True"""' and the
+            # comparison returns True as expected.
+            self._canonical = ast.unparse(ast.parse(str(self)))
+            self.tree._canonical_text = self._canonical
+        return self._canonical
+
+    # Matches the Node against a structural pattern (see compile_pattern) and
+    # returns a dictionary of the captured placeholders, or None if it doesn't
+    # match. Like is_equivalent, this ignores context, so both
+    # Node("print(x)") and the expression inside it match "print(__arg__)".
+
+    def match_pattern(self, pattern):
+        pattern = compile_pattern(pattern)
+        tree = self.tree
+        while tree != None:
+            if (captures := pattern.match(tree)) is not None:
+                return captures
+            if isinstance(tree, ast.Module) and len(tree.body) == 1:
+                tree = tree.body[0]
+            elif isinstance(tree, ast.Expr):
+                tree = tree.value
+            else:
+                tree = None
+        return None
+
+    # Checks whether the pattern matches anything in the Node's tree, at any
+    # depth.
+
+    def has_pattern(self, pattern):
+        if self.tree == None:
+            return False
+        pattern = compile_pattern(pattern)
+        index = _tree_index(self.tree)
+        if pattern.node_type is None:
+            candidates = (node for nodes in index.values() for node in nodes)
+        else:
+            candidates = index.get(pattern.node_type, [])
+        return any(pattern.match(node) is not None for node in candidates)
+
+    # Compares the ASTs of the two Nodes (or of the Node and a code string),
+    # ignoring line and column numbers. Unlike is_equivalent, this does not
+    # ignore context, so the test of "if True:" is not the same as "True".
 
-        # Why parse and unparse again? Because of an edge case when comparing
-        # the `target_str` "'True'" with the test in "if 'True':". These should
-        # be equivalent, but the condition unparses to "'True'", while the
-        # `target_str` becomes '"""True"""' when parsed and unparsed again.
+    def is_structurally_equal(self, other):
+        if isinstance(other, str):
+            other = Node(other)
+        if not isinstance(other, Node):
+            return False
+        if self.tree == None or other.tree == None:
+            return self.tree == None and other.tree == None
+        return _structurally_equal(self.tree, other.tree, located=False)
 
-        # By parsing and unparsing `code_str` we get '"""True"""' and the
-        # comparison returns True as expected.
-        return ast.unparse(ast.parse(code_str)) == ast.unparse(ast.parse(target_str))
+    # Runs several checks against this Node and returns a list with the result
+    # of each. A check is either the name of a Node method followed by its
+    # arguments or a function that takes the Node:
+    #
+    # node.check_all([("has_function", "foo"), ("has_import", "import math"),
+    #   lambda node: node.find_function("foo").has_return("1")])
+    #
+    # The checks are run one after the other with the usual methods, which
+    # share the indexes of the tree. Each index is built in one pass the first
+    # time it's needed and cached on the tree, so after that checks like
+    # has_function, has_call and has_import are lookups.
+
+    def check_all(self, checks):
+        results = []
+        for check in checks:
+            if callable(check):
+                results.append(check(self))
+                continue
+            name, *args = check
+            results.append(_node_method(name)(self, *args))
+        return results
 
     def is_empty(self):
         return self.tree == None
@@ -370,13 +1255,7 @@ class Node:
     # Finds the class definition with the given name
 
     def find_class(self, class_name):
-        if not self._has_body():
-            return Node()
-        for node in self.tree.body:
-            if isinstance(node, ast.ClassDef):
-                if node.name == class_name:
-                    return Node(node)
-        return Node()
+        return self._find_symbol("class", class_name)
 
     def inherits_from(self, *args):
         if not isinstance(self.tree, ast.ClassDef):
@@ -391,15 +1270,52 @@ class Node:
 
     # Find an array of if statements
 
+    def iter_ifs(self, recursive=False):
+        return self._iter_all(ast.If, recursive)
+
     def find_ifs(self):
         return self._find_all(ast.If)
 
+    # Yields the AST nodes of the given type(s) in the body or, if recursive,
+    # anywhere below this node. Both are in source order.
+
+    def _iter_nodes(self, ast_type, recursive=False):
+        if recursive:
+            if self.tree == None:
+                return
+            for node in _iter_descendants(self.tree):
+                if isinstance(node, ast_type):
+                    yield node
+            return
+        index = _body_index(self.tree)
+        matches = [
+            positions
+            for node_type, positions in index.items()
+            if issubclass(node_type, ast_type)
+        ]
+        if len(matches) > 1:
+            positions = sorted(i for positions in matches for i in positions)
+        else:
+            positions = matches[0] if matches else []
+        body = self.tree.body
+        for i in positions:
+            yield body[i]
+
+    def _iter_all(self, ast_type, recursive=False):
+        return (Node(node) for node in self._iter_nodes(ast_type, recursive))
+
     def _find_all(self, ast_type):
-        return [Node(node) for node in self.tree.body if isinstance(node, ast_type)]
+        return list(self._iter_all(ast_type))
+
+    def iter_whiles(self, recursive=False):
+        return self._iter_all(ast.While, recursive)
 
     def find_whiles(self):
         return self._find_all(ast.While)
 
+    def iter_for_loops(self, recursive=False):
+        return self._iter_all(ast.For, recursive)
+
     def find_for_loops(self):
         return self._find_all(ast.For)
 
@@ -413,28 +1329,27 @@ class Node:
             return Node()
         return Node(self.tree.iter)
 
+    def _find_canonical(self, kind, key):
+        if not self._has_body():
+            return Node()
+        index = _canonical_index(self.tree, kind)
+        if not index:
+            return Node()
+        position = index.get(key())
+        if position is None:
+            return Node()
+        return Node(self.tree.body[position])
+
     def find_if(self, if_str):
-        if_list = self._find_all(ast.If)
-        for if_statement in if_list:
-            if if_statement.find_conditions()[0].is_equivalent(if_str):
-                return if_statement
-        return Node()
+        return self._find_canonical("ifs", lambda: _canonical_form(if_str))
 
     def find_while(self, while_str):
-        while_list = self._find_all(ast.While)
-        for while_loop in while_list:
-            if while_loop.find_conditions()[0].is_equivalent(while_str):
-                return while_loop
-        return Node()
+        return self._find_canonical("whiles", lambda: _canonical_form(while_str))
 
     def find_for(self, target_str, iter_str):
-        for_list = self._find_all(ast.For)
-        for for_loop in for_list:
-            if for_loop.find_for_vars().is_equivalent(
-                target_str
-            ) and for_loop.find_for_iter().is_equivalent(iter_str):
-                return for_loop
-        return Node()
+        return self._find_canonical(
+            "fors", lambda: (_canonical_form(target_str), _canonical_form(iter_str))
+        )
 
     # Find an array of bodies in if/elif statement and while or for loops
 
@@ -443,13 +1358,13 @@ class Node:
             if not isinstance(tree, (ast.If, ast.While, ast.For)):
                 return []
             if tree.orelse == []:
-                return [tree.body]
+                return [(tree, "body")]
             if isinstance(tree.orelse[0], (ast.If, ast.While, ast.For)):
-                return [tree.body] + _find_bodies(tree.orelse[0])
+                return [(tree, "body")] + _find_bodies(tree.orelse[0])
 
-            return [tree.body] + [tree.orelse]
+            return [(tree, "body"), (tree, "orelse")]
 
-        return [Node(ast.Module(body, [])) for body in _find_bodies(self.tree)]
+        return [Node(_module(*body)) for body in _find_bodies(self.tree)]
 
     # Find an array of conditions in if/elif statement or while loop
 
@@ -467,6 +1382,9 @@ class Node:
 
         return [Node(test) for test in _find_conditions(self.tree)]
 
+    def iter_matches(self, recursive=False):
+        return self._iter_all(ast.Match, recursive)
+
     def find_matches(self):
         return self._find_all(ast.Match)
 
@@ -492,6 +1410,9 @@ class Node:
             return Node(guard)
         return Node()
 
+    def iter_trys(self, recursive=False):
+        return self._iter_all(ast.Try, recursive)
+
     def find_trys(self):
         return self._find_all(ast.Try)
 
@@ -522,14 +1443,14 @@ class Node:
             return Node()
         if not self.tree.orelse:
             return Node()
-        return Node(ast.Module(self.tree.orelse, []))
+        return Node(_module(self.tree, "orelse"))
 
     def find_finally(self):
         if not isinstance(self.tree, ast.Try):
             return Node()
         if not self.tree.finalbody:
             return Node()
-        return Node(ast.Module(self.tree.finalbody, []))
+        return Node(_module(self.tree, "finalbody"))
 
     # Returs a Boolean indicating if the statements passed as arguments
     # are found in the same order in the tree (statements can be non-consecutive)
@@ -538,12 +1459,169 @@ class Node:
             return False
         if len(args) < 2:
             return False
-        arg_dict = {key: None for key in range(len(args))}
-        for i, node in enumerate(self.tree.body):
-            for j, arg in enumerate(args):
-                if Node(node).is_equivalent(arg):
-                    arg_dict[j] = i
-                    break
-        if None in arg_dict.values():
-            return False
-        return all(arg_dict[n] < arg_dict[n + 1] for n in range(len(arg_dict) - 1))
+        # Each statement counts for the first argument it's equivalent to, and
+        # an argument is found at the last statement equivalent to it, so a
+        # repeated argument is never found.
+        positions = _canonical_index(self.tree, "stmts")
+        seen = set()
+        last = -1
+        for canonical in [_canonical_form(arg) for arg in args]:
+            if canonical in seen:
+                return False
+            seen.add(canonical)
+            found = positions.get(canonical)
+            if found is None or found[-1] <= last:
+                return False
+            last = found[-1]
+        return True
+
+
+# Opt-in profiling. While a profile is active, every Node method (and
+# format_exception, whether its module is imported before or after the profile
+# starts) is replaced by a wrapper that counts the calls and their cumulative
+# time, so there is no cost at all when profiling is off. Times are inclusive,
+# so a helper that calls another helper includes the time spent in it. The
+# iter_* methods return lazy iterators, so only creating them is timed: the
+# time spent iterating counts towards whichever helper consumes them (e.g.
+# find_imports for iter_imports), or towards nothing if it's not a helper. The
+# cache counters are compared with their values when the profile started.
+#
+# with profile() as stats:
+#     Node(_code).find_function("foo").has_return("1")
+# stats.to_dict() # {"calls": {"Node.find_function": {...}, ...}, "caches": {...}}
+#
+# Setting the PY_HELPERS_PROFILE environment variable starts a profile when
+# this module is imported, which current_profile() returns.
+
+_active_profiles = []
+_originals = {}
+
+
+class _Profile:
+    def __init__(self):
+        self.calls = {}
+        self._cache_start = None
+        self._cache_end = None
+
+    def start(self):
+        self.calls = {}
+        self._cache_start = cache_info()
+        self._cache_end = None
+        if not _active_profiles:
+            _instrument()
+        _active_profiles.append(self)
+        return self
+
+    def stop(self):
+        if self in _active_profiles:
+            _active_profiles.remove(self)
+            self._cache_end = cache_info()
+            if not _active_profiles:
+                _uninstrument()
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _record(self, name, seconds):
+        stats = self.calls.get(name)
+        if stats is None:
+            stats = self.calls[name] = {"count": 0, "seconds": 0.0}
+        stats["count"] += 1
+        stats["seconds"] += seconds
+
+    def to_dict(self):
+        end = self._cache_end or cache_info()
+        caches = {}
+        for name, info in end.items():
+            start = (self._cache_start or {}).get(name, {})
+            hits = info["hits"] - start.get("hits", 0)
+            misses = info["misses"] - start.get("misses", 0)
+            caches[name] = {
+                "hits": hits,
+                "misses": misses,
+                "hit_rate": hits / (hits + misses) if hits + misses else None,
+            }
+        return {
+            "calls": {name: dict(stats) for name, stats in self.calls.items()},
+            "caches": caches,
+        }
+
+    def to_json(self):
+        import json
+
+        return json.dumps(self.to_dict())
+
+
+def _record(name, seconds):
+    for active in _active_profiles:
+        active._record(name, seconds)
+
+
+def _profiled(name, func):
+    from functools import wraps
+    from time import perf_counter
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        start = perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _record(name, perf_counter() - start)
+
+    return wrapper
+
+
+def _format_exception_hook(func, kwargs):
+    from time import perf_counter
+
+    start = perf_counter()
+    try:
+        return func(**kwargs)
+    finally:
+        _record("format_exception", perf_counter() - start)
+
+
+def _instrument():
+    import sys
+
+    for name, attr in list(vars(Node).items()):
+        if callable(attr) and (not name.startswith("_") or name.endswith("__")):
+            if name in ("__getattribute__", "__setattr__", "__init_subclass__"):
+                continue
+            _originals[name] = attr
+            setattr(Node, name, _profiled(f"Node.{name}", attr))
+    if module := sys.modules.get("format_exception"):
+        module._profile_hook = _format_exception_hook
+
+
+def _uninstrument():
+    import sys
+
+    for name, attr in _originals.items():
+        setattr(Node, name, attr)
+    _originals.clear()
+    if module := sys.modules.get("format_exception"):
+        module._profile_hook = None
+
+
+def profile():
+    return _Profile()
+
+
+def current_profile():
+    return _active_profiles[-1] if _active_profiles else None
+
+
+def _profile_from_environment():
+    import os
+
+    if os.environ.get("PY_HELPERS_PROFILE"):
+        profile().start()
+
+
+_profile_from_environment()
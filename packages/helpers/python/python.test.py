@@ -1,8 +1,31 @@
 import unittest
 import ast
+import json
 import sys
-from py_helpers import Node
-from format_exception import drop_until, build_message, format_exception
+import py_helpers
+from py_helpers import (
+    Node,
+    cache_info,
+    clear_caches,
+    compile_pattern,
+    compile_plan,
+    current_profile,
+    profile,
+)
+from format_exception import (
+    build_message,
+    clear_exception_cache,
+    clear_sources,
+    exception_counts,
+    drop_until,
+    extract_exception,
+    format_exception,
+    format_extracted,
+    fingerprint_exception,
+    register_source,
+    snapshot_exception,
+    write_exceptions,
+)
 
 
 class TestConstructor(unittest.TestCase):
@@ -27,6 +50,519 @@ class TestConstructor(unittest.TestCase):
         self.assertRaises(TypeError, lambda: Node(1))
 
 
+class TestParseCache(unittest.TestCase):
+    def setUp(self):
+        clear_caches()
+
+    def test_reuses_tree_for_same_source(self):
+        code_str = "def foo():\n  pass"
+
+        self.assertIs(Node(code_str).tree, Node(code_str).tree)
+        self.assertEqual(cache_info()["parse"]["hits"], 1)
+        self.assertEqual(cache_info()["parse"]["misses"], 1)
+
+    def test_caches_syntax_errors(self):
+        self.assertRaises(SyntaxError, lambda: Node("def"))
+        self.assertRaises(SyntaxError, lambda: Node("def"))
+        self.assertEqual(cache_info()["parse"]["hits"], 1)
+
+    def test_raises_a_fresh_syntax_error_each_time(self):
+        errors = []
+        for _ in range(2):
+            try:
+                Node("x =")
+            except SyntaxError as err:
+                errors.append(err)
+
+        self.assertIsNot(errors[0], errors[1])
+        self.assertEqual(errors[0].args, errors[1].args)
+
+    def test_evicts_least_recently_used(self):
+        cache = py_helpers._LRUCache(maxsize=2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+        cache.put("c", 3)
+
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.info()["evictions"], 1)
+
+    def test_evicts_when_over_byte_limit(self):
+        cache = py_helpers._LRUCache(maxsize=10, maxbytes=5)
+        cache.put("a", 1, size=3)
+        cache.put("b", 2, size=3)
+        cache.put("c", 3, size=6)
+
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("b"), 2)
+        self.assertIsNone(cache.get("c"))
+        self.assertEqual(cache.info()["bytes"], 3)
+
+    def test_charges_parsed_trees_by_their_estimated_size(self):
+        clear_caches()
+        Node("x = 1")
+
+        self.assertEqual(
+            cache_info()["parse"]["bytes"],
+            len("x = 1") * py_helpers._TREE_BYTES_PER_CHAR,
+        )
+
+
+class TestCanonicalCache(unittest.TestCase):
+    def setUp(self):
+        clear_caches()
+
+    def test_caches_target_strings(self):
+        Node("x = 1").is_equivalent("x   =   1")
+        Node("x = 2").is_equivalent("x   =   1")
+
+        self.assertEqual(cache_info()["canonical"]["hits"], 1)
+
+    def test_still_handles_string_edge_case(self):
+        node = Node("if 'True':\n  pass").find_ifs()[0].find_conditions()[0]
+
+        self.assertTrue(node.is_equivalent("'True'"))
+        self.assertTrue(node.is_equivalent("'True'"))
+
+    def test_does_not_cache_syntax_errors(self):
+        self.assertRaises(SyntaxError, lambda: Node("x = 1").is_equivalent("x ="))
+        self.assertEqual(cache_info()["canonical"]["size"], 0)
+
+
+class TestNodeStringCache(unittest.TestCase):
+    def test_unparses_once(self):
+        node = Node("x  =  1")
+
+        self.assertIs(str(node), str(node))
+
+    def test_comparisons_reuse_canonical_string(self):
+        node = Node("if 'True':\n  pass").find_ifs()[0].find_conditions()[0]
+
+        self.assertTrue(node.is_equivalent("'True'"))
+        canonical = node._canonical
+        self.assertFalse(node.is_equivalent("'False'"))
+        self.assertIs(node._canonical, canonical)
+
+    def test_uses_slots(self):
+        self.assertFalse(hasattr(Node(), "__dict__"))
+
+
+class TestStructuralHashing(unittest.TestCase):
+    def test_equal_nodes_have_equal_hashes(self):
+        code_str = "def foo(a, b=1):\n  return a + b"
+        node = Node(code_str)
+        other = Node(ast.parse(code_str))
+
+        self.assertEqual(node, other)
+        self.assertEqual(hash(node), hash(other))
+
+    def test_equality_includes_locations(self):
+        self.assertNotEqual(Node("x = 1"), Node("\nx = 1"))
+
+    def test_equality_distinguishes_constant_types(self):
+        self.assertNotEqual(Node("x = 1"), Node("x = True"))
+        self.assertNotEqual(Node("x = 1"), Node("x = 1.0"))
+
+    def test_can_be_used_in_sets(self):
+        node = Node("x = 1\ny = 2")
+        nodes = {node[0], node[1], Node("x = 1")[0], Node()}
+
+        self.assertEqual(len(nodes), 3)
+        self.assertIn(Node(), nodes)
+
+    def test_is_structurally_equal_ignores_locations(self):
+        node = Node("if True:\n  x = 1")
+
+        self.assertTrue(
+            node.find_ifs()[0].find_bodies()[0].is_structurally_equal("x = 1")
+        )
+        self.assertTrue(Node("x = 1").is_structurally_equal(Node("\n\nx  =  1")))
+        self.assertFalse(Node("x = 1").is_structurally_equal("x = 2"))
+
+    def test_is_structurally_equal_does_not_ignore_context(self):
+        node = Node("if True:\n  pass").find_ifs()[0].find_conditions()[0]
+
+        self.assertTrue(node.is_equivalent("True"))
+        self.assertFalse(node.is_structurally_equal("True"))
+
+    def test_hashes_are_the_same_in_every_process(self):
+        import os
+        import pickle
+        import subprocess
+
+        code = (
+            "import pickle, sys\n"
+            "from py_helpers import Node\n"
+            "node = Node(\"def foo(a='x'):\\n  return a.b\")\n"
+            "hash(node)\n"
+            "sys.stdout.buffer.write(pickle.dumps(node))\n"
+        )
+        pickled = [
+            subprocess.run(
+                [sys.executable, "-c", code],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                env={**os.environ, "PYTHONHASHSEED": seed},
+                check=True,
+                capture_output=True,
+            ).stdout
+            for seed in ("1", "2")
+        ]
+        nodes = [pickle.loads(data) for data in pickled]
+        node = Node("def foo(a='x'):\n  return a.b")
+
+        self.assertEqual(nodes[0], nodes[1])
+        self.assertEqual(nodes[0], node)
+        self.assertTrue(nodes[1].is_structurally_equal(node))
+
+    def test_is_structurally_equal_with_empty_nodes(self):
+        self.assertTrue(Node().is_structurally_equal(Node()))
+        self.assertFalse(Node().is_structurally_equal("x = 1"))
+        self.assertFalse(Node("x = 1").is_structurally_equal(Node()))
+
+
+class TestNodeTypeIndex(unittest.TestCase):
+    def test_finds_statements_in_order(self):
+        code_str = """
+import a
+if x:
+  pass
+from b import c
+while y:
+  pass
+import d
+"""
+        node = Node(code_str)
+
+        imports = node.find_imports()
+        self.assertEqual(len(imports), 3)
+        self.assertTrue(imports[0].is_equivalent("import a"))
+        self.assertTrue(imports[1].is_equivalent("from b import c"))
+        self.assertTrue(imports[2].is_equivalent("import d"))
+        self.assertEqual(len(node.find_ifs()), 1)
+        self.assertEqual(node.find_for_loops(), [])
+
+    def test_index_is_shared_by_nodes_of_the_same_source(self):
+        code_str = "if x:\n  pass\nif y:\n  pass"
+
+        index = py_helpers._body_index(Node(code_str).tree)
+
+        self.assertIs(py_helpers._body_index(Node(code_str).tree), index)
+
+    def test_find_body_reuses_module(self):
+        node = Node("def foo():\n  if x:\n    pass").find_function("foo")
+
+        self.assertIs(node.find_body().tree, node.find_body().tree)
+        self.assertEqual(len(node.find_body().find_ifs()), 1)
+
+    def test_tree_index_includes_nested_nodes_in_source_order(self):
+        node = Node("def foo():\n  a = b\n  if c:\n    d = e")
+
+        names = py_helpers._tree_index(node.tree)[ast.Name]
+
+        self.assertEqual([name.id for name in names], ["a", "b", "c", "d", "e"])
+
+
+class TestSymbolIndex(unittest.TestCase):
+    def setUp(self):
+        self.code_str = """
+def foo():
+  return 1
+
+def foo():
+  return 2
+
+async def bar():
+  pass
+
+class Baz:
+  pass
+
+x = 1
+self.y: int = 2
+a.b.c = 3
+z: int = 4
+count += 1
+"""
+
+    def test_finds_first_definition(self):
+        node = Node(self.code_str)
+
+        self.assertTrue(
+            node.find_function("foo").is_equivalent("def foo():\n  return 1")
+        )
+        self.assertTrue(
+            node.find_async_function("bar").is_equivalent("async def bar():\n  pass")
+        )
+        self.assertTrue(node.find_class("Baz").is_equivalent("class Baz:\n  pass"))
+        self.assertTrue(node.find_variable("z").is_equivalent("z: int = 4"))
+        self.assertTrue(node.find_aug_variable("count").is_equivalent("count += 1"))
+
+    def test_does_not_mix_kinds(self):
+        node = Node(self.code_str)
+
+        self.assertFalse(node.has_function("bar"))
+        self.assertFalse(node.has_class("foo"))
+        self.assertFalse(node.has_variable("count"))
+        self.assertEqual(node.find_async_function("foo"), Node())
+
+    def test_ignores_nested_attribute_targets(self):
+        node = Node(self.code_str)
+
+        self.assertFalse(node.has_variable("a.b"))
+        self.assertFalse(node.has_variable("self.y"))
+
+    def test_has_helpers_handle_nodes_without_bodies(self):
+        node = Node("x = 1").find_variable("x")
+
+        self.assertFalse(node.has_function("foo"))
+        self.assertFalse(node.has_class("Foo"))
+        self.assertFalse(node.has_variable("x"))
+        self.assertFalse(Node().has_variable("x"))
+
+
+class TestCheckAll(unittest.TestCase):
+    def setUp(self):
+        self.node = Node(
+            """
+import math
+
+def foo():
+  return 1
+
+print(foo())
+if x:
+  pass
+"""
+        )
+
+    def test_returns_result_per_check(self):
+        results = self.node.check_all(
+            [
+                ("has_function", "foo"),
+                ("has_function", "bar"),
+                ("has_import", "import math"),
+                ("has_call", "print(foo())"),
+                ("find_ifs",),
+                lambda node: node.find_function("foo").has_return("1"),
+            ]
+        )
+
+        self.assertEqual(results[:4], [True, False, True, True])
+        self.assertEqual(len(results[4]), 1)
+        self.assertTrue(results[5])
+
+    def test_indexes_body_once(self):
+        self.node.check_all([("has_function", "foo"), ("find_ifs",)])
+        indexes = self.node.tree._body_indexes
+
+        self.node.check_all([("has_class", "Foo"), ("find_whiles",)])
+
+        self.assertIs(self.node.tree._body_indexes, indexes)
+
+    def test_looks_up_calls_and_imports_in_the_statement_index(self):
+        checks = [
+            ("has_call", "print(foo())"),
+            ("has_call", "import math"),
+            ("has_import", "import  math"),
+            ("has_import", "print(foo())"),
+        ]
+        self.assertEqual(self.node.check_all(checks), [True, False, True, False])
+        index = self.node.tree._canonical_indexes["stmts"]
+
+        self.assertEqual(self.node.check_all(checks), [True, False, True, False])
+        self.assertIs(self.node.tree._canonical_indexes["stmts"], index)
+
+    def test_rejects_unknown_checks(self):
+        self.assertRaises(ValueError, lambda: self.node.check_all([("nope",)]))
+        self.assertRaises(ValueError, lambda: self.node.check_all([("_has_body",)]))
+        self.assertRaises(ValueError, lambda: self.node.check_all([("tree",)]))
+
+
+class TestStructuralPatterns(unittest.TestCase):
+    def setUp(self):
+        self.node = Node(
+            """
+for i in range(10):
+  total = i
+  print(i)
+print("done", end="")
+"""
+        )
+
+    def test_any_matches_without_capturing(self):
+        self.assertEqual(Node("print(x)").match_pattern("print(__any__)"), {})
+        self.assertIsNone(Node("print(x, y)").match_pattern("print(__any__)"))
+
+    def test_captures_placeholders(self):
+        captures = self.node[0].match_pattern("for __x__ in range(__n__): ...")
+
+        self.assertTrue(captures["x"].is_equivalent("i"))
+        self.assertTrue(captures["n"].is_equivalent("10"))
+
+    def test_repeated_placeholders_must_match_the_same_code(self):
+        pattern = "for __x__ in __it__:\n  ...\n  print(__x__)"
+
+        self.assertIsNotNone(self.node[0].match_pattern(pattern))
+        self.assertIsNone(Node("for i in x:\n  print(j)").match_pattern(pattern))
+
+    def test_ellipsis_matches_any_statements(self):
+        self.assertIsNotNone(self.node[0].match_pattern("for __x__ in __it__: ..."))
+        self.assertIsNone(
+            self.node[0].match_pattern("for __x__ in __it__:\n  print(__x__)")
+        )
+
+    def test_starred_placeholders_match_any_number_of_items(self):
+        captures = Node("print(1, 2, sep='')").match_pattern(
+            "print(*__args__, **__kwargs__)"
+        )
+
+        self.assertEqual([str(arg) for arg in captures["args"]], ["1", "2"])
+        self.assertEqual(len(captures["kwargs"]), 1)
+
+    def test_identifier_placeholders(self):
+        captures = Node("def foo(a, b=1):\n  return a").match_pattern(
+            "def __f__(__a__, __b__=__default__):\n  return __a__"
+        )
+
+        self.assertEqual(captures["f"], "foo")
+        self.assertEqual(captures["a"], "a")
+        self.assertTrue(captures["default"].is_equivalent("1"))
+
+    def test_special_names_are_not_placeholders(self):
+        self.assertIsNotNone(Node("x = __name__").match_pattern("x = __name__"))
+        self.assertIsNone(Node("x = y").match_pattern("x = __name__"))
+
+    def test_constants_are_compared_literally(self):
+        self.assertIsNone(Node("print('a')").match_pattern("print('__x__')"))
+        self.assertIsNone(Node("x = 1").match_pattern("x = True"))
+
+    def test_has_pattern_searches_whole_tree(self):
+        self.assertTrue(self.node.has_pattern("print(__any__)"))
+        self.assertTrue(self.node.has_pattern("print(__any__, **__any__)"))
+        self.assertFalse(self.node.has_pattern("input(*__any__)"))
+        self.assertFalse(Node().has_pattern("print(__any__)"))
+
+    def test_compiled_patterns_are_cached(self):
+        clear_caches()
+        pattern = compile_pattern("print(__any__)")
+
+        self.assertIs(compile_pattern("print(__any__)"), pattern)
+        self.assertIs(compile_pattern(pattern), pattern)
+
+    def test_rejects_multiple_statements(self):
+        self.assertRaises(ValueError, lambda: compile_pattern("x = 1\ny = 2"))
+
+
+class TestCanonicalIndex(unittest.TestCase):
+    def setUp(self):
+        clear_caches()
+        self.code_str = """
+x = 1
+if x > 0:
+  pass
+while (x):
+  x -= 1
+for i in range( 3 ):
+  pass
+x = 1
+print(x)
+"""
+
+    def test_built_once_per_tree(self):
+        node = Node(self.code_str)
+        self.assertTrue(node.has_stmt("x=1"))
+        index = node.tree._canonical_indexes["stmts"]
+
+        self.assertIs(Node(self.code_str).tree._canonical_indexes["stmts"], index)
+        self.assertEqual(index["x = 1"], [0, 4])
+        self.assertNotIn("ifs", node.tree._canonical_indexes)
+
+    def test_finds_by_canonical_form(self):
+        node = Node(self.code_str)
+
+        self.assertIs(node.find_if("(x > 0)").tree, node.tree.body[1])
+        self.assertIs(node.find_while("x").tree, node.tree.body[2])
+        self.assertIs(node.find_for("i", "range(3)").tree, node.tree.body[3])
+        self.assertEqual(node.find_for("j", "range(3)"), Node())
+
+    def test_is_ordered_uses_last_occurrence(self):
+        node = Node(self.code_str)
+
+        self.assertTrue(node.is_ordered("x = 1", "print(x)"))
+        self.assertFalse(node.is_ordered("print(x)", "x = 1"))
+        self.assertFalse(node.is_ordered("x = 1", "x = 1"))
+
+
+class TestLazyFinders(unittest.TestCase):
+    def setUp(self):
+        self.node = Node(
+            """
+x = 1
+print(x)
+def foo():
+  x = 2
+  if x:
+    print(x)
+    [i for i in x]
+  def bar():
+    pass
+print(x)
+"""
+        )
+
+    def test_iter_matches_find(self):
+        self.assertEqual(
+            list(self.node.iter_calls("print")), self.node.find_calls("print")
+        )
+        self.assertEqual(
+            list(self.node.iter_variables("x")), self.node.find_variables("x")
+        )
+        self.assertEqual(
+            list(self.node.iter_functions("foo")), self.node.find_functions("foo")
+        )
+
+    def test_iter_is_lazy(self):
+        calls = self.node.iter_calls("print")
+
+        self.assertTrue(next(calls).is_equivalent("print(x)"))
+        self.assertTrue(next(calls).is_equivalent("print(x)"))
+        self.assertRaises(StopIteration, lambda: next(calls))
+
+    def test_recursive_searches_nested_blocks_in_source_order(self):
+        variables = list(self.node.iter_variables("x", recursive=True))
+        calls = list(self.node.iter_calls("print", recursive=True))
+
+        self.assertEqual([str(var) for var in variables], ["x = 1", "x = 2"])
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(calls[1].tree.lineno, 7)
+        self.assertEqual(len(list(self.node.iter_functions("bar", recursive=True))), 1)
+        self.assertEqual(len(list(self.node.iter_comps(recursive=True))), 1)
+        self.assertEqual(len(list(self.node.iter_ifs(recursive=True))), 1)
+        self.assertEqual(list(self.node.iter_ifs()), [])
+
+    def test_recursive_handles_empty_nodes(self):
+        self.assertEqual(list(Node().iter_ifs(recursive=True)), [])
+
+    def test_recursive_calls_include_nested_expressions(self):
+        node = Node(
+            """
+x = print(1)
+def foo():
+  return obj.print(print(2))
+print(3)
+"""
+        )
+        calls = node.find_calls("print", recursive=True)
+
+        self.assertEqual(
+            [str(call) for call in calls],
+            ["print(1)", "obj.print(print(2))", "print(2)", "print(3)"],
+        )
+        self.assertEqual(len(node.find_calls("print")), 1)
+        self.assertIs(node.tree._usage_index["calls"]["print"][0], calls[0].tree)
+
+
 class TestVariableHelpers(unittest.TestCase):
     def test_find_variable_can_handle_all_asts(self):
         node = Node("x = 1")
@@ -314,6 +850,39 @@ def spam(a: str, b: bool) -> None:
         self.assertFalse(node.find_function("foo").has_args("a, b"))
         self.assertTrue(node.find_function("spam").has_args("a: str, b: bool"))
 
+    def test_has_args_with_any_return_annotation(self):
+        code_str = """
+def foo(a, *args, b=1, **kwargs) -> typing.List[int]:
+  return []
+
+def spam(a) -> "int":
+  pass
+"""
+        node = Node(code_str)
+
+        self.assertTrue(node.find_function("foo").has_args("a,*args,b = 1,**kwargs"))
+        self.assertFalse(node.find_function("foo").has_args("a, *args, b, **kwargs"))
+        self.assertTrue(node.find_function("spam").has_args("a"))
+        self.assertTrue(node.find_function("foo").has_returns("typing.List[int]"))
+
+    def test_signature_is_computed_once(self):
+        function = Node("def foo(a, b=2):\n  pass").find_function("foo")
+        self.assertTrue(function.has_args("a, b=2"))
+
+        self.assertEqual(function.tree.args._signature, ast.dump(function.tree.args))
+        self.assertTrue(function.has_args("a, b=2"))
+
+    def test_argument_strings_are_not_in_the_parse_cache(self):
+        clear_caches()
+        function = Node("def foo(a, b=2):\n  pass").find_function("foo")
+        self.assertTrue(function.has_args("a, b=2"))
+        self.assertFalse(function.has_args("a, b=3"))
+        self.assertTrue(function.has_args("a, b=2"))
+
+        self.assertEqual(cache_info()["parse"]["size"], 1)
+        self.assertEqual(cache_info()["args"]["size"], 2)
+        self.assertEqual(cache_info()["args"]["hits"], 1)
+
     def test_has_returns(self):
         code_str = """
 def foo() -> int:
@@ -2031,6 +2600,359 @@ ValueError: This error has no value
             )
             self.assertEqual(formatted_exception, expected_str)
 
+    def test_format_exception_skips_harness_frames(self):
+        import linecache
+        from unittest import mock
+
+        try:
+            exec("def nest():\n    raise ValueError\nnest()")
+        except Exception as err:
+            exception = err
+        getline = linecache.getline
+        with mock.patch("linecache.getline", side_effect=getline) as looked_up:
+            format_exception(
+                exception=exception,
+                traceback=exception.__traceback__,
+                filename="<string>",
+            )
+
+        filenames = {call.args[0] for call in looked_up.call_args_list}
+        self.assertEqual(filenames, {"<string>"})
+
+    def test_registered_source_is_shown(self):
+        import linecache
+
+        # Some Python versions underline calls, but never a whole line that
+        # is only an attribute.
+        code = (
+            "class Box:\n"
+            "    @property\n"
+            "    def value(self):\n"
+            '        raise ValueError("no value")\n'
+            "Box().value"
+        )
+        expected_str = """Traceback (most recent call last):
+  File "main.py", line 5, in <module>
+    Box().value
+  File "main.py", line 4, in value
+    raise ValueError("no value")
+ValueError: no value
+"""
+        register_source(filename="/user_code.py", source=code)
+        try:
+            exec(compile(code, "/user_code.py", "exec"), {})
+        except Exception as err:
+            exception = err
+        formatted_exception = format_exception(
+            exception=exception,
+            traceback=exception.__traceback__,
+            filename="/user_code.py",
+            new_filename="main.py",
+        )
+        clear_sources()
+
+        self.assertEqual(formatted_exception, expected_str)
+        self.assertNotIn("/user_code.py", linecache.cache)
+
+    def test_registered_source_keeps_line_numbers(self):
+        code = 's = "a\u2028b\x0cc"\nx = 1\nraise ValueError("no value")\n'
+        register_source(filename="/user_code.py", source=code)
+        try:
+            exec(compile(code, "/user_code.py", "exec"), {})
+        except Exception as err:
+            exception = err
+        formatted_exception = format_exception(
+            exception=exception,
+            traceback=exception.__traceback__,
+            filename="/user_code.py",
+            new_filename="main.py",
+        )
+        clear_sources()
+
+        self.assertIn(
+            '  File "main.py", line 3, in <module>\n'
+            '    raise ValueError("no value")\n',
+            formatted_exception,
+        )
+
+    def test_extract_exception(self):
+        code = 'def nest():\n    raise ValueError("no value")\nnest()'
+        register_source(filename="/user_code.py", source=code)
+        try:
+            exec(compile(code, "/user_code.py", "exec"), {})
+        except Exception as err:
+            exception = err
+        extracted = extract_exception(
+            exception=exception,
+            traceback=exception.__traceback__,
+            filename="/user_code.py",
+            new_filename="main.py",
+        )
+        formatted_exception = format_exception(
+            exception=exception,
+            traceback=exception.__traceback__,
+            filename="/user_code.py",
+            new_filename="main.py",
+        )
+        clear_sources()
+
+        self.assertEqual(extracted["type"], "ValueError")
+        self.assertEqual(extracted["message"], "no value")
+        self.assertEqual(
+            [
+                (f["filename"], f["lineno"], f["function"], f["line"])
+                for f in extracted["frames"]
+            ],
+            [
+                ("main.py", 3, "<module>", "nest()"),
+                ("main.py", 2, "nest", 'raise ValueError("no value")'),
+            ],
+        )
+        self.assertEqual(
+            format_extracted(json.loads(json.dumps(extracted))), formatted_exception
+        )
+
+    def test_multi_line_expressions(self):
+        import traceback
+
+        code = "x = (1 +\n     'a')"
+        register_source(filename="/user_code.py", source=code)
+        try:
+            exec(compile(code, "/user_code.py", "exec"), {})
+        except TypeError as err:
+            exception = err
+        args = dict(
+            exception=exception,
+            traceback=exception.__traceback__,
+            filename="/user_code.py",
+            new_filename="main.py",
+        )
+        formatted_exception = format_exception(**args)
+        extracted = extract_exception(**args)
+        # Skips the frame of this test.
+        expected_str = "".join(
+            traceback.format_exception(
+                TypeError, exception, exception.__traceback__.tb_next
+            )
+        ).replace('"/user_code.py"', '"main.py"')
+        clear_sources()
+
+        self.assertEqual(formatted_exception, expected_str)
+        self.assertEqual(extracted["frames"][0]["line"], "x = (1 +")
+        self.assertEqual(
+            format_extracted(json.loads(json.dumps(extracted))), expected_str
+        )
+
+    def test_exception_whose_str_fails(self):
+        class Unprintable(Exception):
+            def __str__(self):
+                raise RuntimeError("no str")
+
+        try:
+            exec("raise E()", {"E": Unprintable})
+        except Unprintable as err:
+            exception = err
+        args = dict(
+            exception=exception, traceback=exception.__traceback__, filename="<string>"
+        )
+
+        self.assertIsNone(extract_exception(**args)["message"])
+        self.assertIn("Unprintable", format_exception(**args))
+        self.assertIsNone(snapshot_exception(**args)["message"])
+
+    def test_write_exceptions(self):
+        import io
+
+        extracted = [
+            {"type": "NameError", "message": "x", "frames": [], "exception": []},
+            {"type": "KeyError", "message": "'k'", "frames": [], "exception": []},
+        ]
+        ndjson, array = io.StringIO(), io.StringIO()
+
+        self.assertEqual(write_exceptions(iter(extracted), ndjson), 2)
+        self.assertEqual(write_exceptions(extracted, array, lines=False), 2)
+        self.assertEqual(
+            [json.loads(line) for line in ndjson.getvalue().splitlines()], extracted
+        )
+        self.assertEqual(json.loads(array.getvalue()), extracted)
+
+    def test_formatted_exceptions_are_cached_by_fingerprint(self):
+        import format_exception as module
+
+        code = compile("def nest(n):\n    raise ValueError(n)\nnest(N)", "<fp>", "exec")
+        fingerprints = []
+        formatted = []
+        clear_exception_cache()
+        for n in (1, 1, 2):
+            try:
+                exec(code, {"N": n})
+            except ValueError as err:
+                args = dict(exception=err, traceback=err.__traceback__, filename="<fp>")
+                fingerprints.append(fingerprint_exception(**args))
+                formatted.append(format_exception(**args))
+
+        self.assertEqual(fingerprints[0], fingerprints[1])
+        self.assertNotEqual(fingerprints[0], fingerprints[2])
+        self.assertIs(formatted[0], formatted[1])
+        self.assertTrue(formatted[2].endswith("ValueError: 2\n"))
+        self.assertEqual(exception_counts(), {fingerprints[0]: 2, fingerprints[2]: 1})
+        self.assertEqual(len(module._formatted), 2)
+        clear_exception_cache()
+        self.assertEqual(exception_counts(), {})
+
+    def test_fingerprints_include_the_exception_lines_as_shown(self):
+        from traceback import format_exception_only
+
+        clear_exception_cache()
+        code = compile("box.colour", "<fp>", "exec")
+        for attribute in ("color", "colon"):
+            box = type("Box", (), {attribute: None})()
+            try:
+                exec(code, {"box": box})
+            except AttributeError as err:
+                # Newer Python versions suggest the attribute that was meant.
+                self.assertTrue(
+                    format_exception(
+                        exception=err, traceback=err.__traceback__, filename="<fp>"
+                    ).endswith("".join(format_exception_only(err)))
+                )
+        clear_exception_cache()
+
+    def test_fingerprints_include_every_line_of_the_code(self):
+        fingerprints = []
+        for operand in ("'a'", "'b'"):
+            code = compile(f"x = (1 +\n     {operand})", "<fp>", "exec")
+            register_source(filename="<fp>", source=f"x = (1 +\n     {operand})")
+            try:
+                exec(code, {})
+            except TypeError as err:
+                fingerprints.append(
+                    fingerprint_exception(
+                        exception=err, traceback=err.__traceback__, filename="<fp>"
+                    )
+                )
+            clear_sources()
+
+        self.assertNotEqual(fingerprints[0], fingerprints[1])
+
+    def test_counts_are_bounded(self):
+        import format_exception as module
+
+        code = compile("raise ValueError(N)", "<fp>", "exec")
+        fingerprints = []
+        clear_exception_cache()
+        limit, module.MAX_COUNTED = module.MAX_COUNTED, 2
+        try:
+            for n in (1, 2, 1, 3):
+                try:
+                    exec(code, {"N": n})
+                except ValueError as err:
+                    args = dict(
+                        exception=err, traceback=err.__traceback__, filename="<fp>"
+                    )
+                    fingerprints.append(fingerprint_exception(**args))
+                    format_exception(**args)
+        finally:
+            module.MAX_COUNTED = limit
+
+        self.assertEqual(exception_counts(), {fingerprints[0]: 2, fingerprints[3]: 1})
+        clear_exception_cache()
+
+    def _recursion_error(self):
+        code = "def f(n):\n    return g(n)\ndef g(n):\n    return f(n + 1)\nf(0)"
+        try:
+            exec(compile(code, "<rec>", "exec"), {})
+        except RecursionError as err:
+            return err
+
+    def test_repeated_frames_are_collapsed(self):
+        try:
+            exec(compile("def f(n):\n    f(n + 1)\nf(0)", "<rec>", "exec"), {})
+        except RecursionError as err:
+            exception = err
+        extracted = extract_exception(
+            exception=exception, traceback=exception.__traceback__, filename="<rec>"
+        )
+
+        self.assertEqual(len(extracted["frames"]), 4)
+        self.assertEqual(
+            extracted["frames"][-1]["repeated"], extracted["frame_count"] - 4
+        )
+        self.assertIn(
+            "[Previous line repeated",
+            format_exception(
+                exception=exception,
+                traceback=exception.__traceback__,
+                filename="<rec>",
+            ),
+        )
+
+    def test_head_and_tail(self):
+        exception = self._recursion_error()
+        args = dict(
+            exception=exception, traceback=exception.__traceback__, filename="<rec>"
+        )
+        formatted = format_exception(**args, head=2, tail=1)
+        extracted = extract_exception(**args, head=2, tail=1)
+
+        lines = formatted.splitlines()
+        self.assertEqual(
+            lines[1:4],
+            [
+                '  File "<rec>", line 5, in <module>',
+                '  File "<rec>", line 2, in f',
+                f"  [{extracted['frame_count'] - 3} more frames not shown]",
+            ],
+        )
+        self.assertTrue(lines[4].startswith('  File "<rec>", line '))
+        self.assertEqual(len(lines), 6)
+        self.assertEqual(format_extracted(extracted), formatted)
+
+    def test_max_size(self):
+        exception = self._recursion_error()
+        formatted = format_exception(
+            exception=exception,
+            traceback=exception.__traceback__,
+            filename="<rec>",
+            max_size=300,
+        )
+
+        self.assertLessEqual(len(formatted), 300)
+        self.assertRegex(formatted, r"\[\d+ more frames not shown\]\n")
+        self.assertTrue(formatted.endswith("maximum recursion depth exceeded\n"))
+
+    def test_snapshot_releases_frames(self):
+        import weakref
+
+        code = (
+            "class Big:\n    pass\n"
+            "def nest():\n    big = Big()\n    REFS.append(weakref.ref(big))\n"
+            "    1 / 0\n"
+            "nest()"
+        )
+        register_source(filename="<snap>", source=code)
+        refs = []
+        try:
+            exec(compile(code, "<snap>", "exec"), {"REFS": refs, "weakref": weakref})
+        except ZeroDivisionError as err:
+            exception = err
+        args = dict(
+            exception=exception, traceback=exception.__traceback__, filename="<snap>"
+        )
+        formatted_exception = format_exception(**args)
+        self.assertIsNotNone(refs[0]())
+
+        snapshot = snapshot_exception(**args, new_filename="main.py")
+
+        self.assertIsNone(refs[0]())
+        self.assertNotIn("line", snapshot["frames"][0])
+        self.assertEqual(
+            format_extracted(snapshot),
+            formatted_exception.replace('"<snap>"', '"main.py"'),
+        )
+        self.assertEqual(snapshot["frames"][1]["line"], "1 / 0")
+        clear_sources()
+
     def test_format_syntax_error(self):
         code = """
 def
@@ -2126,5 +3048,473 @@ ValueError: This error has no value
             self.assertEqual(formatted_exception, expected_str)
 
 
+class TestPlans(unittest.TestCase):
+    def setUp(self):
+        self.checks = [
+            [("find_function", "foo"), ("find_body",), ("has_call", "bar()")],
+            [("find_function", "foo"), ("find_body",), ("has_variable", "x")],
+            [("find_ifs",), 0, ("find_conditions",), 0, ("is_equivalent", "x > 0")],
+            ("has_import", "import math"),
+        ]
+        self.node = Node(
+            """
+import math
+def foo():
+  bar()
+if x > 0:
+  pass
+"""
+        )
+
+    def test_runs_checks_in_order(self):
+        plan = compile_plan(self.checks)
+
+        self.assertEqual(plan.run(self.node), [True, False, True, True])
+
+    def test_evaluates_shared_prefixes_once(self):
+        plan = compile_plan(self.checks)
+
+        self.assertEqual(len(plan._root[0]), 3)
+        find_foo = plan._root[0][("find_function", "foo")]
+        self.assertEqual(len(find_foo[0]), 1)
+        self.assertEqual(len(find_foo[0][("find_body",)][0]), 2)
+
+    def test_serializes(self):
+        plan = compile_plan(json.loads(compile_plan(self.checks).to_json()))
+
+        self.assertEqual(plan.run(self.node), [True, False, True, True])
+
+    def test_failing_steps_only_affect_their_checks(self):
+        plan = compile_plan(self.checks)
+
+        self.assertEqual(
+            plan.run(Node("import math\ndef foo():\n  x = 1")),
+            [False, True, None, True],
+        )
+
+    def test_raises_errors_in_checks(self):
+        plan = compile_plan([[("find_function", "foo"), ("has_args",)]])
+
+        self.assertRaises(TypeError, lambda: plan.run(self.node))
+
+    def test_rejects_unknown_methods(self):
+        self.assertRaises(ValueError, lambda: compile_plan([("_has_body",)]))
+
+    def test_batch_grader_accepts_plans(self):
+        from batch import BatchGrader
+
+        grader = BatchGrader(compile_plan(self.checks), processes=0)
+        verdicts = list(grader.grade(["def foo():\n  bar()\nif x > 0:\n  pass"]))
+
+        self.assertEqual(verdicts[0]["results"], [True, False, True, False])
+
+
+class TestReparse(unittest.TestCase):
+    def setUp(self):
+        clear_caches()
+        self.code_str = """import math
+
+def foo():
+  return 1
+
+x = 1
+
+def bar():
+  return 2
+"""
+        self.node = Node(self.code_str)
+
+    def assert_same_as_parse(self, node, code_str):
+        self.assertEqual(
+            ast.dump(node.tree, include_attributes=True),
+            ast.dump(ast.parse(code_str), include_attributes=True),
+        )
+
+    def test_reuses_unchanged_statements(self):
+        code_str = self.code_str.replace("x = 1", "x = 2")
+
+        node = self.node.reparse(code_str)
+
+        self.assert_same_as_parse(node, code_str)
+        self.assertIs(node.tree.body[1], self.node.tree.body[1])
+        self.assertIsNot(node.tree.body[2], self.node.tree.body[2])
+        self.assertIs(node.tree.body[3], self.node.tree.body[3])
+
+    def test_does_not_reuse_statements_after_added_lines(self):
+        code_str = self.code_str.replace("x = 1", "x = 1\ny = 2")
+
+        node = self.node.reparse(code_str)
+
+        self.assert_same_as_parse(node, code_str)
+        self.assertIs(node.tree.body[1], self.node.tree.body[1])
+        self.assertEqual(node.find_function("bar").tree.lineno, 9)
+
+    def test_does_not_split_lines_with_several_statements(self):
+        code_str = self.code_str.replace("x = 1", "x = 1; y = 2")
+        node = self.node.reparse(code_str)
+
+        new_code_str = code_str.replace("y = 2", "y = 3")
+
+        self.assert_same_as_parse(node.reparse(new_code_str), new_code_str)
+
+    def test_only_splits_on_line_breaks(self):
+        code_str = "x = 1\n\x0c\ny = 2\nz = 3\n"
+        node = Node(code_str)
+
+        new_code_str = code_str.replace("z = 3", "z = 4")
+
+        self.assert_same_as_parse(node.reparse(new_code_str), new_code_str)
+
+        code_str = 'x = "a\u2028b"\ny = 2\n'
+        node = Node(code_str)
+
+        new_code_str = code_str.replace("y = 2", "y = 3")
+
+        self.assert_same_as_parse(node.reparse(new_code_str), new_code_str)
+
+    def test_falls_back_to_parsing_everything(self):
+        code_str = self.code_str.replace("x = 1", 'x = """')
+
+        self.assertRaises(SyntaxError, lambda: self.node.reparse(code_str))
+
+        # This makes x part of foo's body, so foo has to be parsed again too.
+        code_str = self.code_str.replace("x = 1", "  x = 1")
+
+        self.assert_same_as_parse(self.node.reparse(code_str), code_str)
+
+    def test_result_is_cached(self):
+        code_str = self.code_str.replace("x = 1", "x = 2")
+
+        node = self.node.reparse(code_str)
+
+        self.assertIs(Node(code_str).tree, node.tree)
+        self.assert_same_as_parse(node.reparse(self.code_str), self.code_str)
+
+    def test_nodes_not_from_source_are_parsed(self):
+        node = Node(ast.parse("x = 1")).reparse("x = 2")
+
+        self.assert_same_as_parse(node, "x = 2")
+
+
+class TestParseStore(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = self.directory.name
+        self.code_str = "import math\n\ndef foo(a):\n  return math.sqrt(a)\n"
+        clear_caches()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_loads_the_same_tree_as_parsing(self):
+        from parse_store import ParseStore
+
+        with ParseStore(self.path) as store:
+            node = store.load(self.code_str)
+
+        self.assertEqual(
+            ast.dump(node.tree, include_attributes=True),
+            ast.dump(ast.parse(self.code_str), include_attributes=True),
+        )
+        self.assertTrue(node.find_function("foo").has_return("math.sqrt(a)"))
+
+    def test_persists_between_stores(self):
+        from parse_store import ParseStore
+
+        with ParseStore(self.path) as store:
+            store.put(self.code_str)
+            store.put("x = 1")
+        clear_caches()
+
+        with ParseStore(self.path) as store:
+            self.assertEqual(len(store), 2)
+            self.assertIn("x = 1", store)
+            self.assertIsNone(store.get("x = 2"))
+            node = store.get(self.code_str)
+
+        self.assertTrue(node.has_function("foo"))
+        self.assertIs(Node(self.code_str).tree, node.tree)
+
+    def test_stores_precomputed_data_and_hashes(self):
+        from parse_store import ParseStore
+
+        with ParseStore(self.path) as store:
+            store.put(self.code_str)
+            tree = store.get(self.code_str).tree
+
+        self.assertIn("_body_indexes", tree.__dict__)
+        self.assertIn("_canonical_text", tree.body[1].__dict__)
+        self.assertEqual(
+            tree._node_hashes, py_helpers._hashes(ast.parse(self.code_str))
+        )
+
+    def test_records_do_not_depend_on_earlier_checks(self):
+        import os
+        from parse_store import ParseStore
+
+        with ParseStore(os.path.join(self.path, "cold")) as store:
+            store.put(self.code_str)
+        node = Node(self.code_str)
+        node.has_function("foo")
+        node.find_function("foo").has_call("math.sqrt(a)")
+        node.has_stmt("import math")
+        node.find_calls("sqrt", recursive=True)
+        with ParseStore(os.path.join(self.path, "warm")) as store:
+            store.put(self.code_str)
+
+        records = []
+        for name in ("cold", "warm"):
+            with open(os.path.join(self.path, name, "records"), "rb") as f:
+                records.append(f.read())
+        self.assertEqual(records[0], records[1])
+
+    def test_drops_partly_written_entries(self):
+        import os
+        from parse_store import ParseStore
+
+        with ParseStore(self.path) as store:
+            store.put("x = 1")
+        with open(os.path.join(self.path, "index"), "ab") as index:
+            index.write(b"partial")
+
+        with ParseStore(self.path) as store:
+            self.assertEqual(len(store), 1)
+            store.put(self.code_str)
+
+        with ParseStore(self.path) as store:
+            self.assertEqual(len(store), 2)
+            self.assertTrue(store.get(self.code_str).has_function("foo"))
+
+    def test_stores_syntax_errors(self):
+        from parse_store import ParseStore
+
+        with ParseStore(self.path) as store:
+            store.put("def")
+            store.put("if x:\npass")
+
+        with ParseStore(self.path) as store:
+            self.assertRaises(SyntaxError, lambda: store.get("def"))
+            self.assertRaises(IndentationError, lambda: store.get("if x:\npass"))
+
+
+class TestBatchGrader(unittest.TestCase):
+    def setUp(self):
+        self.checks = [("has_function", "foo"), ("has_import", "import math")]
+        self.submissions = [
+            "def foo():\n  pass",
+            "import math",
+            "def",
+            "import math\ndef foo():\n  pass",
+        ]
+
+    def assert_verdicts(self, verdicts):
+        self.assertEqual([v["index"] for v in verdicts], [0, 1, 2, 3])
+        self.assertEqual(verdicts[0]["results"], [True, False])
+        self.assertEqual(verdicts[1]["results"], [False, True])
+        self.assertIsNone(verdicts[2]["results"])
+        self.assertTrue(verdicts[2]["error"].startswith("SyntaxError"))
+        self.assertEqual(verdicts[3]["results"], [True, True])
+
+    def test_grades_in_process(self):
+        from batch import BatchGrader
+
+        grader = BatchGrader(self.checks, processes=0, chunksize=3)
+
+        self.assert_verdicts(list(grader.grade(self.submissions)))
+        self.assertEqual(grader.stats()["submissions"], 4)
+
+    def test_grades_in_process_pool_in_order(self):
+        from batch import BatchGrader
+
+        grader = BatchGrader(self.checks, processes=2, chunksize=1, max_pending=2)
+
+        self.assert_verdicts(list(grader.grade(iter(self.submissions))))
+        self.assertGreater(grader.stats()["per_second"], 0)
+
+
+class TestProfiling(unittest.TestCase):
+    def setUp(self):
+        clear_caches()
+
+    def test_counts_calls_and_time(self):
+        with profile() as stats:
+            node = Node("def foo():\n    return 1")
+            node.find_function("foo").has_return("1")
+            node.has_function("foo")
+
+        calls = stats.to_dict()["calls"]
+        self.assertEqual(calls["Node.find_function"]["count"], 1)
+        self.assertEqual(calls["Node.has_function"]["count"], 1)
+        self.assertEqual(calls["Node.has_return"]["count"], 1)
+        self.assertGreater(calls["Node.__init__"]["count"], 1)
+        self.assertGreaterEqual(calls["Node.has_function"]["seconds"], 0.0)
+
+    def test_reports_cache_hit_rates(self):
+        Node("x = 1")
+        with profile() as stats:
+            Node("x = 1")
+            Node("y = 1")
+
+        parse = stats.to_dict()["caches"]["parse"]
+        self.assertEqual((parse["hits"], parse["misses"]), (1, 1))
+        self.assertEqual(parse["hit_rate"], 0.5)
+
+    def test_no_instrumentation_when_off(self):
+        original = Node.has_function
+        with profile():
+            self.assertIsNot(Node.has_function, original)
+            self.assertIs(current_profile().__class__, profile().__class__)
+        self.assertIs(Node.has_function, original)
+        self.assertIsNone(current_profile())
+
+    def test_nested_profiles(self):
+        with profile() as outer:
+            Node("x = 1").has_variable("x")
+            with profile() as inner:
+                Node("x = 1").has_variable("x")
+            Node("x = 1").has_variable("x")
+
+        self.assertEqual(outer.to_dict()["calls"]["Node.has_variable"]["count"], 3)
+        self.assertEqual(inner.to_dict()["calls"]["Node.has_variable"]["count"], 1)
+
+    def test_profiles_format_exception(self):
+        try:
+            exec("1 / 0", {"__file__": "<exec>"})
+        except ZeroDivisionError as err:
+            exception = err
+        with profile() as stats:
+            format_exception(
+                exception=exception,
+                traceback=exception.__traceback__,
+                filename="<string>",
+            )
+
+        self.assertEqual(stats.to_dict()["calls"]["format_exception"]["count"], 1)
+        self.assertEqual(json.loads(stats.to_json()), stats.to_dict())
+
+    def test_profiles_format_exception_imported_after_profile_started(self):
+        import os
+        import subprocess
+
+        code = (
+            "from py_helpers import current_profile\n"
+            "from format_exception import format_exception\n"
+            "try:\n"
+            "    1 / 0\n"
+            "except ZeroDivisionError as err:\n"
+            "    format_exception(\n"
+            "        exception=err, traceback=err.__traceback__, filename='<string>'\n"
+            "    )\n"
+            "print(current_profile().to_json())\n"
+        )
+        output = subprocess.run(
+            [sys.executable, "-c", code],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            env={**os.environ, "PY_HELPERS_PROFILE": "1"},
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+
+        calls = json.loads(output)["calls"]
+        self.assertEqual(calls["format_exception"]["count"], 1)
+
+
+class TestBenchmarks(unittest.TestCase):
+    def test_every_public_method_is_benchmarked(self):
+        from benchmark import CASES
+
+        public = {
+            name
+            for name in dir(Node)
+            if not name.startswith("_") and callable(getattr(Node, name))
+        }
+
+        self.assertEqual(public - set(CASES), set())
+
+    def test_cases_run(self):
+        from benchmark import run
+
+        report = run(corpus=["small"], number=1)
+
+        self.assertTrue(all(r["median_us"] >= 0 for r in report["results"]))
+
+    def test_measures_imports(self):
+        from benchmark import measure_imports
+
+        imports = measure_imports(number=1)
+
+        self.assertEqual(set(imports), {"source", "bundle"})
+        self.assertTrue(all(result["median_ms"] > 0 for result in imports.values()))
+
+
+class TestBundle(unittest.TestCase):
+    def import_helpers(self, directory):
+        import subprocess
+
+        return subprocess.run(
+            [
+                sys.executable,
+                "-B",
+                "-v",
+                "-c",
+                "import ast_helpers; print(hasattr(ast_helpers, 'from_source'))",
+            ],
+            cwd=directory,
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+
+    def test_imports_the_precompiled_helpers(self):
+        import os
+        import shutil
+        import tempfile
+        import bundle
+
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, "ast_helpers.py")
+            shutil.copyfile(bundle.SOURCE, source)
+            path = bundle.build(os.path.join(tmp, "__pycache__"))
+            result = self.import_helpers(tmp)
+
+        self.assertEqual(os.path.basename(path), bundle.bundle_name())
+        self.assertEqual(result.stdout.strip(), "False")
+        self.assertIn(f"code object from '{path}'", result.stderr)
+
+    def test_ignores_a_stale_bundle(self):
+        import os
+        import shutil
+        import tempfile
+        import bundle
+
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, "ast_helpers.py")
+            shutil.copyfile(bundle.SOURCE, source)
+            path = bundle.build(os.path.join(tmp, "__pycache__"))
+            with open(source, "a") as f:
+                f.write("\nfrom_source = True\n")
+            result = self.import_helpers(tmp)
+
+        self.assertEqual(result.stdout.strip(), "True")
+        self.assertNotIn(f"code object from '{path}'", result.stderr)
+
+    def test_only_builds_with_the_python_pyodide_ships(self):
+        import contextlib
+        import io
+        import tempfile
+        import bundle
+
+        tag, bundle.PYODIDE_CACHE_TAG = bundle.PYODIDE_CACHE_TAG, "cpython-00"
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                with contextlib.redirect_stderr(io.StringIO()):
+                    self.assertRaises(SystemExit, bundle.main, ["--output", tmp])
+        finally:
+            bundle.PYODIDE_CACHE_TAG = tag
+
+
 if __name__ == "__main__":
     unittest.main()
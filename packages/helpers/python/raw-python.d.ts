@@ -2,3 +2,9 @@ declare module "*.py" {
   const content: string;
   export default content;
 }
+
+// The precompiled helpers, see bundle-loader.cjs.
+declare module "*.py?bundle" {
+  const bundle: { name: string; data: string };
+  export default bundle;
+}
@@ -5,6 +5,7 @@ import { loadPyodide, type PyodideInterface } from "pyodide/pyodide.js";
 import type { PyProxy, PythonError } from "pyodide/ffi";
 import pkg from "pyodide/package.json";
 import * as helpers from "../../helpers/lib";
+import astHelpersBundle from "../../helpers/python/py_helpers.py?bundle";
 import chai from "chai";
 import {
   Fail,
@@ -221,6 +222,16 @@ ${rawTestString}`;
       },
     );
 
+    // The precompiled helpers are imported instead of compiling the source,
+    // as long as the source hasn't changed since they were built.
+    // eslint-disable-next-line @typescript-eslint/no-unsafe-call, @typescript-eslint/no-unsafe-member-access
+    pyodide.FS.mkdirTree("/home/pyodide/__pycache__");
+    // eslint-disable-next-line @typescript-eslint/no-unsafe-call, @typescript-eslint/no-unsafe-member-access
+    pyodide.FS.writeFile(
+      `/home/pyodide/__pycache__/${astHelpersBundle.name}`,
+      Uint8Array.from(atob(astHelpersBundle.data), (c) => c.charCodeAt(0)),
+    );
+
     return pyodide;
   }
 
@@ -145,8 +145,21 @@ const testRunnerConfig =
       module: {
         rules: [
           {
-            test: /\.py/,
-            type: "asset/source",
+            test: /\.py$/,
+            oneOf: [
+              {
+                // The bytecode bundle of the Python helpers, see bundle.py.
+                resourceQuery: /bundle/,
+                type: "javascript/auto",
+                loader: path.resolve(
+                  __dirname,
+                  "packages/helpers/python/bundle-loader.cjs",
+                ),
+              },
+              {
+                type: "asset/source",
+              },
+            ],
           },
           ...getTSRules(isDev),
         ],